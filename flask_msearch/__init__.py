@@ -25,6 +25,7 @@ class Search(object):
             "simple": "flask_msearch.simple_backend.SimpleSearch",
             "whoosh": "flask_msearch.whoosh_backend.WhooshSearch",
             "elasticsearch": "flask_msearch.elasticsearch_backend.ElasticSearch",
+            "database": "flask_msearch.database_backend.DatabaseSearch",
         }
         if backend not in backends:
             raise ValueError('backends {} not exists.'.format(backend))
@@ -1,15 +1,33 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import datetime
+import functools
 import logging
-
+import math
+import os
+import threading
+import weakref
+from collections import Counter
+from operator import attrgetter
+
+from sqlalchemy import Integer, String, case, cast, event
+from sqlalchemy import column as sql_column
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.inspection import inspect
+from sqlalchemy.orm import joinedload, lazyload, selectinload
 from werkzeug.utils import import_string
 
-from .signal import default_signal
+from .cache import SearchCache
+from .signal import default_signal, record_changes
 from ._compat import locked_cached_property, models_committed
 
+try:
+    from sqlalchemy import values
+except ImportError:
+    # sqlalchemy < 1.4
+    values = None
+
 
 def get_mapper(query):
     if hasattr(query, "_mapper_zero"):
@@ -38,6 +56,234 @@ def relation_column(instance, fields):
     return getattr(_field, fields[1]) if _field else ''
 
 
+def field_getter(model, field):
+    '''
+    compile accessor of field, same as relation_column for dotted field
+    except that None is returned when relation is missing
+    '''
+    if '.' not in field:
+        return attrgetter(field)
+    name, attr = field.split('.')[:2]
+    dynamic = getattr(model, name).property.lazy == 'dynamic'
+
+    def getter(instance):
+        value = getattr(instance, name)
+        if dynamic:
+            value = value.first()
+        return getattr(value, attr) if value else None
+
+    return getter
+
+
+def document_builder(model, fields, converters=None):
+    '''
+    compile a function that builds document of instance once, values are
+    converted by converters of field, None is kept as it is.
+
+    :param converters: dict of field and converter, default is str
+    '''
+    converters = converters or dict()
+    getters = [(field, field_getter(model, field), converters.get(field, str))
+               for field in fields]
+
+    def build(instance):
+        document = dict()
+        for field, getter, convert in getters:
+            value = getter(instance)
+            document[field] = None if value is None else convert(value)
+        return document
+
+    return build
+
+
+def relation_options(model, fields):
+    '''
+    eager load relations of fields such as: tag.name
+    dynamic relation can't be eager loaded
+    '''
+    options = []
+    for name in sorted(set(f.split('.')[0] for f in fields if '.' in f)):
+        attr = getattr(model, name)
+        relation = attr.property
+        if relation.lazy == 'dynamic':
+            continue
+        if relation.uselist:
+            options.append(selectinload(attr))
+        else:
+            options.append(joinedload(attr))
+    return options
+
+
+class Hit(object):
+    '''
+    search hit with stored fields, which is returned by search engine
+    without querying database.
+    '''
+    __slots__ = ("pk", "rank", "score", "fields")
+
+    def __init__(self, pk, rank, score=None, fields=None):
+        self.pk = pk
+        self.rank = rank
+        self.score = score
+        self.fields = fields or dict()
+
+    def __getitem__(self, name):
+        return self.fields[name]
+
+    def __repr__(self):
+        return '<Hit:{}>'.format(self.pk)
+
+
+class Pagination(object):
+    '''
+    page of search results, total is the count of hits from search engine
+    '''
+
+    def __init__(self, query, page, per_page, total, items):
+        self.query = query
+        self.page = page
+        self.per_page = per_page
+        self.total = total
+        self.items = items
+
+    @property
+    def pages(self):
+        if self.per_page == 0 or not self.total:
+            return 0
+        return int(math.ceil(self.total / float(self.per_page)))
+
+    @property
+    def has_prev(self):
+        return self.page > 1
+
+    @property
+    def prev_num(self):
+        return self.page - 1 if self.has_prev else None
+
+    @property
+    def has_next(self):
+        return self.page < self.pages
+
+    @property
+    def next_num(self):
+        return self.page + 1 if self.has_next else None
+
+
+# dialects which support VALUES list in FROM clause
+VALUES_DIALECTS = ("sqlite", "postgresql")
+
+
+class RankedQuery(object):
+    '''
+    query mixin which reorders rows by rank of hits in python, used when
+    database doesn't support VALUES list. limit and offset of query are
+    applied before reordering.
+    '''
+    _msearch_ranks = None
+
+    def _msearch_sort(self, rows):
+        pk, ranks = self._msearch_ranks
+        return sorted(
+            rows,
+            key=lambda row: ranks.get(str(getattr(row, pk, None)), len(ranks)))
+
+    def __iter__(self):
+        rows = super(RankedQuery, self).__iter__()
+        if self._msearch_ranks is None:
+            return rows
+        return iter(self._msearch_sort(rows))
+
+    def all(self):
+        if self._msearch_ranks is None:
+            return super(RankedQuery, self).all()
+        return self._msearch_sort(super(RankedQuery, self).all())
+
+
+def hits_query(query,
+               column,
+               hits,
+               rank_order=False,
+               case_limit=100,
+               dialect=None):
+    '''
+    filter query by primary keys of hits, when rank_order is True and count
+    of hits is greater than case_limit, join a VALUES list of (pk, rank)
+    instead of ordering by a CASE expression with one WHEN per hit, rows
+    are reordered in python when database doesn't support VALUES list.
+
+    :param dialect: dialect name, default is dialect of query's bind
+    '''
+    if not hits:
+        return query.filter(False)
+    if rank_order and len(hits) > case_limit:
+        if dialect is None:
+            dialect = query.session.get_bind(
+                mapper=get_mapper(query)).dialect.name
+        if values is None or dialect not in VALUES_DIALECTS:
+            # such as mysql which has no VALUES list
+            result_query = query.filter(
+                column.in_(set(hit.pk for hit in hits)))
+            result_query._msearch_ranks = (column.key, {
+                str(hit.pk): hit.rank
+                for hit in hits
+            })
+            return result_query
+        try:
+            python_type = column.type.python_type
+        except NotImplementedError:
+            python_type = None
+        ranks = values(
+            sql_column("pk", column.type),
+            sql_column("rank", Integer),
+            name="msearch_rank",
+        ).data([(python_type(hit.pk) if python_type else hit.pk, hit.rank)
+                for hit in hits]).cte()
+        return query.join(ranks, ranks.c.pk == column).order_by(ranks.c.rank)
+
+    result_query = query.filter(column.in_(set(hit.pk for hit in hits)))
+    if rank_order:
+        result_query = result_query.order_by(
+            case({hit.pk: hit.rank for hit in hits}, value=column))
+    return result_query
+
+
+def _after_fork_in_child(ref):
+    backend = ref()
+    if backend is not None:
+        backend.after_fork()
+
+
+def diff_pks(database_pks, index_pks):
+    '''
+    merge two ascending streams of primary key strings, yield (pk, "missing")
+    when pk is only in database and (pk, "orphan") when pk is only in index.
+    '''
+    def ascending(pks, name):
+        last = None
+        for pk in pks:
+            if last is not None and pk < last:
+                raise ValueError(
+                    "{} primary keys are not sorted: {!r} < {!r}, collation "
+                    "of database should be binary".format(name, pk, last))
+            last = pk
+            yield pk
+
+    database_pks = ascending(database_pks, "database")
+    index_pks = ascending(index_pks, "index")
+    a = next(database_pks, None)
+    b = next(index_pks, None)
+    while a is not None or b is not None:
+        if b is None or (a is not None and a < b):
+            yield a, "missing"
+            a = next(database_pks, None)
+        elif a is None or b < a:
+            yield b, "orphan"
+            b = next(index_pks, None)
+        else:
+            a = next(database_pks, None)
+            b = next(index_pks, None)
+
+
 class BaseSchema(object):
     def __init__(self, index):
         self.index = index
@@ -83,6 +329,10 @@ class BaseSchema(object):
 
 
 class BaseBackend(object):
+    # index is stored in application database, which can't be created
+    # before tables of models
+    database_index = False
+
     def __init__(self, app=None, db=None, analyzer=None):
         """
         You can custom analyzer by::
@@ -91,7 +341,11 @@ class BaseBackend(object):
             search = Search(analyzer = ChineseAnalyzer)
         """
         self._signal = None
+        self._queue = None
+        self._dependencies = None
         self._indexs = dict()
+        self.cache = None
+        self.metrics = Counter()
         self.db = db
         self.analyzer = analyzer
         if app is not None:
@@ -104,6 +358,16 @@ class BaseBackend(object):
         app.config.setdefault("MSEARCH_ANALYZER", None)
         app.config.setdefault("MSEARCH_ENABLE", True)
         app.config.setdefault("MSEARCH_LOGGER", logging.WARNING)
+        app.config.setdefault("MSEARCH_QUEUE_SIZE", 10000)
+        app.config.setdefault("MSEARCH_QUEUE_BATCH_SIZE", 500)
+        app.config.setdefault("MSEARCH_QUEUE_INTERVAL", 1.0)
+        app.config.setdefault("MSEARCH_CACHE", False)
+        app.config.setdefault("MSEARCH_CACHE_SIZE", 100000)
+        app.config.setdefault("MSEARCH_CACHE_TTL", 60)
+        app.config.setdefault("MSEARCH_RANK_CASE_LIMIT", 100)
+        app.config.setdefault("MSEARCH_RELATED_BATCH_SIZE", 500)
+        app.config.setdefault("MSEARCH_WARMUP", False)
+        app.config.setdefault("MSEARCH_KEEP_VERSIONS", 2)
 
     def _signal_connect(self, app):
         if app.config["MSEARCH_ENABLE"]:
@@ -112,7 +376,7 @@ class BaseBackend(object):
                 self._signal = import_string(signal)
             else:
                 self._signal = signal
-            models_committed.connect(self.index_signal)
+            models_committed.connect(self.index_signal, sender=app)
 
     @locked_cached_property
     def logger(self):
@@ -129,6 +393,42 @@ class BaseBackend(object):
         if not self.db:
             self.db = self.app.extensions['sqlalchemy'].db
         self.db.Model.query_class = self._query_class(self.db.Model.query_class)
+        if app.config["MSEARCH_ENABLE"] and not event.contains(
+                self.db.session, "before_flush", record_changes):
+            event.listen(self.db.session, "before_flush", record_changes)
+        if app.config.get("MSEARCH_CACHE"):
+            self.cache = SearchCache(
+                app.config["MSEARCH_CACHE_SIZE"],
+                app.config["MSEARCH_CACHE_TTL"],
+            )
+        if hasattr(os, "register_at_fork"):
+            # weakref would not keep backend alive
+            os.register_at_fork(after_in_child=functools.partial(
+                _after_fork_in_child, weakref.ref(self)))
+        if app.config.get("MSEARCH_WARMUP") and not self.database_index:
+            self.warmup()
+
+    def warmup(self):
+        '''
+        create index of all searchable models before the first request
+        '''
+        with self.app.app_context():
+            return [
+                self.index(m) for m in get_tables(self.db.Model)
+                if hasattr(m, "__searchable__") or hasattr(m, "__msearch__")
+            ]
+
+    def after_fork(self):
+        '''
+        called in child process after fork, threads, locks, file handles and
+        connections inherited from parent can't be used.
+        '''
+        self._queue = None
+        if self.cache is not None:
+            self.cache._lock = threading.Lock()
+        for ix in self._indexs.values():
+            if hasattr(ix, "after_fork"):
+                ix.after_fork()
 
     def _query_class(self, q):
         _self = self
@@ -144,20 +444,98 @@ class BaseBackend(object):
                      model='__all__',
                      update=False,
                      delete=False,
-                     yield_per=100):
+                     yield_per=100,
+                     chunk_size=None,
+                     resume=False,
+                     rebuild=False):
+        '''
+        :param chunk_size: when chunk_size is set, page the table by primary key
+                           and commit index every chunk, the last primary key
+                           would be saved as checkpoint of index.
+        :param resume: when resume is True, continue from the last checkpoint
+        :param rebuild: when rebuild is True, build a new index aside and
+                        switch to it when finished, live index is untouched
+                        while building.
+        '''
         if model == '__all__':
-            return self.create_all_index(update, delete)
+            return self.create_all_index(
+                update,
+                delete,
+                yield_per,
+                chunk_size=chunk_size,
+                resume=resume,
+                rebuild=rebuild,
+            )
         ix = self.index(model)
-        instances = model.query.enable_eagerloads(False).yield_per(yield_per)
-        for instance in instances:
-            self.create_one_index(instance, update, delete, False)
+        if rebuild:
+            return self._rebuild_index(ix, yield_per)
+        if chunk_size:
+            return self._chunked_create_index(
+                ix, update, delete, chunk_size, resume)
+        instances = self._index_query(ix).yield_per(yield_per)
+        self.create_many_index(ix, instances, update, delete)
         ix.commit()
         return ix
 
-    def create_all_index(self, update=False, delete=False, yield_per=100):
+    def _chunked_create_index(self, ix, update, delete, chunk_size, resume):
+        pk = getattr(ix.model, ix.pk)
+        last = ix.get_meta("checkpoint") if resume else None
+        while True:
+            # don't keep a long running transaction over the whole table,
+            # and pending changes of caller's session are untouched
+            session = self.db.session.session_factory()
+            try:
+                chunk = self._index_query(ix, session).order_by(pk)
+                if last is not None:
+                    chunk = chunk.filter(pk > last)
+                instances = chunk.limit(chunk_size).all()
+                if not instances:
+                    break
+                self.create_many_index(ix, instances, update, delete)
+                ix.commit()
+                last = getattr(instances[-1], ix.pk)
+            finally:
+                session.close()
+            ix.set_meta("checkpoint", last)
+            self.logger.debug('index {} checkpoint: {}'.format(ix.name, last))
+        ix.set_meta("checkpoint", None)
+        return ix
+
+    def _rebuild_index(self, index, yield_per=100):
+        raise NotImplementedError(
+            "rebuild is not supported by {}".format(self.__class__.__name__))
+
+    def _index_query(self, index, session=None):
+        query = index.model.query
+        if session is not None:
+            query = session.query(index.model)
+        return query.options(
+            lazyload('*'),
+            *relation_options(index.model, index.searchable),
+        )
+
+    def create_many_index(self, index, instances, update=False, delete=False):
+        for instance in instances:
+            self.create_one_index(instance, update, delete, False)
+        return index
+
+    def create_all_index(self,
+                         update=False,
+                         delete=False,
+                         yield_per=100,
+                         chunk_size=None,
+                         resume=False,
+                         rebuild=False):
         return [
-            self.create_index(m, update, delete, yield_per)
-            for m in get_tables(self.db.Model)
+            self.create_index(
+                m,
+                update,
+                delete,
+                yield_per,
+                chunk_size=chunk_size,
+                resume=resume,
+                rebuild=rebuild,
+            ) for m in get_tables(self.db.Model)
             if hasattr(m, "__searchable__") or hasattr(m, "__msearch__")
         ]
 
@@ -173,12 +551,215 @@ class BaseBackend(object):
     def delete_all_index(self, yield_per=100):
         return self.create_all_index(delete=True, yield_per=yield_per)
 
-    def update_index(self, model='__all__', yield_per=100):
-        return self.create_index(model, update=True, yield_per=yield_per)
+    def update_index(self, model='__all__', yield_per=100, incremental=False):
+        '''
+        :param incremental: only update rows whose ``__msearch_updated_at__``
+                            column is null or not older than the watermark of
+                            last run, deleted rows are not detected.
+        '''
+        if not incremental:
+            return self.create_index(model, update=True, yield_per=yield_per)
+        if model == '__all__':
+            return [
+                self.update_index(m, yield_per, incremental)
+                for m in get_tables(self.db.Model)
+                if hasattr(m, "__searchable__") or hasattr(m, "__msearch__")
+            ]
+        updated_at = getattr(model, "__msearch_updated_at__", None)
+        if updated_at is None:
+            return self.create_index(model, update=True, yield_per=yield_per)
+
+        ix = self.index(model)
+        column = getattr(model, updated_at)
+        query = self._index_query(ix).order_by(column)
+        watermark = self._load_watermark(column, ix.get_meta("watermark"))
+        if watermark is not None:
+            # rows committed later with the same timestamp are not missed,
+            # and rows without timestamp are always reindexed
+            query = query.filter((column >= watermark) | column.is_(None))
+
+        last = watermark
+        for instance in query.yield_per(yield_per):
+            self.create_one_index(instance, update=True, commit=False)
+            value = getattr(instance, updated_at)
+            if value is not None:
+                last = value
+        ix.commit()
+        if last is not None:
+            if hasattr(last, "isoformat"):
+                last = last.isoformat()
+            ix.set_meta("watermark", last)
+        return ix
+
+    def _load_watermark(self, column, value):
+        if value is None or not isinstance(value, str):
+            return value
+        python_type = column.type.python_type
+        if python_type is datetime.datetime:
+            return datetime.datetime.fromisoformat(value)
+        if python_type is datetime.date:
+            return datetime.date.fromisoformat(value)
+        return value
 
     def delete_index(self, model='__all__', yield_per=100):
         return self.create_index(model, delete=True, yield_per=yield_per)
 
+    def reconcile(self, model='__all__', batch_size=500):
+        '''
+        find documents which are missing from index or orphaned in index by
+        merging sorted primary keys of database and index, then index the
+        missing ones and delete the orphans in batches.
+
+        :return: dict of missing and orphan count
+        '''
+        if model == '__all__':
+            return [
+                self.reconcile(m, batch_size)
+                for m in get_tables(self.db.Model)
+                if hasattr(m, "__searchable__") or hasattr(m, "__msearch__")
+            ]
+        ix = self.index(model)
+        result = {"missing": 0, "orphan": 0}
+        pks = {"missing": [], "orphan": []}
+        diff = diff_pks(
+            self._database_pks(ix, batch_size),
+            self._index_pks(ix, batch_size),
+        )
+        for pk, drift in diff:
+            pks[drift].append(pk)
+            result[drift] += 1
+            if len(pks[drift]) >= batch_size:
+                self._reconcile(ix, drift, pks[drift])
+                pks[drift] = []
+        for drift in ("missing", "orphan"):
+            if pks[drift]:
+                self._reconcile(ix, drift, pks[drift])
+            self.metrics["reconcile_{}".format(drift)] += result[drift]
+        self.logger.info('reconcile index {}: {} missing, {} orphan'.format(
+            ix.name, result["missing"], result["orphan"]))
+        return result
+
+    def _reconcile(self, index, drift, pks):
+        if drift == "orphan":
+            self._delete_pks(index, pks)
+        else:
+            self.create_many_index(index, self._instances(index, pks))
+        index.commit()
+
+    def _instances(self, index, pks):
+        '''
+        query instances by primary keys of string
+        '''
+        column = getattr(index.model, index.pk)
+        try:
+            python_type = column.type.python_type
+        except NotImplementedError:
+            python_type = str
+        return self._index_query(index).filter(
+            column.in_([python_type(pk) for pk in pks]))
+
+    def _database_pks(self, index, batch_size=500):
+        '''
+        yield primary keys of database as string in ascending order, table is
+        sorted once and rows are streamed in batches
+        '''
+        pk = cast(getattr(index.model, index.pk), String)
+        # missing rows are loaded by scoped session while streaming
+        session = self.db.session.session_factory()
+        try:
+            query = session.query(pk).order_by(pk).yield_per(batch_size)
+            for row in query:
+                yield row[0]
+        finally:
+            session.close()
+
+    def _index_pks(self, index, batch_size=500):
+        '''
+        yield primary keys of index as string in ascending order
+        '''
+        raise NotImplementedError
+
+    def _delete_pks(self, index, pks):
+        '''
+        delete documents by primary keys without commit
+        '''
+        raise NotImplementedError
+
+    def msearch_hits(self,
+                     m,
+                     query,
+                     fields=None,
+                     limit=None,
+                     or_=False,
+                     page=None,
+                     per_page=20,
+                     **kwargs):
+        '''
+        search hits with primary key, score and stored fields, database
+        would not be queried::
+
+            for hit in search.msearch_hits(Post, "book", limit=20):
+                print(hit.pk, hit.score, hit["title"])
+        '''
+        total, hits = self._search_hits(
+            m, query, fields, limit, or_, page, per_page, **kwargs)
+        return hits
+
+    def _search_hits(self,
+                     m,
+                     query,
+                     fields=None,
+                     limit=None,
+                     or_=False,
+                     page=None,
+                     per_page=20,
+                     **kwargs):
+        '''
+        total and list of hit from search engine, only hits of the page would
+        be returned when page is not None.
+        cached if MSEARCH_CACHE is True
+        '''
+        if page is not None and page < 1:
+            raise ValueError("page must be greater than 0")
+        ix = self.index(m) if self.cache is not None else None
+        # index without generation can't be cached
+        if getattr(ix, "generation", None) is None:
+            return self._hits(
+                m, query, fields, limit, or_, page, per_page, **kwargs)
+        key = (
+            ix.name,
+            query,
+            tuple(fields) if fields else None,
+            limit,
+            or_,
+            page,
+            per_page if page is not None else None,
+            repr(sorted(kwargs.items())),
+        )
+        generation = ix.generation
+        result = self.cache.get(key, generation)
+        if result is None:
+            result = self._hits(
+                m, query, fields, limit, or_, page, per_page, **kwargs)
+            self.cache.set(key, generation, result, len(result[1]))
+        return result
+
+    def _hits(self,
+              m,
+              query,
+              fields=None,
+              limit=None,
+              or_=False,
+              page=None,
+              per_page=20,
+              **kwargs):
+        '''
+        total and list of hit from search engine
+        '''
+        raise NotImplementedError(
+            "search hits are not supported by {}".format(
+                self.__class__.__name__))
+
     def whoosh_search(self, m, query, fields=None, limit=None, or_=False):
         self.logger.warning(
             'whoosh_search has been replaced by msearch.please use msearch')
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import threading
+import time
+from collections import OrderedDict
+
+
+class SearchCache(object):
+    '''
+    LRU cache of search hits with ttl, entry would be invalidated when the
+    generation of index has been changed by commit.
+
+    :param maxsize: max count of hits of all entries
+    :param ttl: seconds of entry alive
+    '''
+
+    def __init__(self, maxsize=100000, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _pop(self, key):
+        value, size, generation, expires = self._entries.pop(key)
+        self.size -= size
+
+    def get(self, key, generation):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (entry[2] != generation
+                                      or entry[3] < time.time()):
+                self._pop(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, generation, value, size=None):
+        if size is None:
+            size = len(value)
+        if size > self.maxsize:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._pop(key)
+            self._entries[key] = (value, size, generation,
+                                  time.time() + self.ttl)
+            self.size += size
+            while self.size > self.maxsize:
+                self._pop(next(iter(self._entries)))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    @property
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(self._entries),
+            "size": self.size,
+        }
@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import json
+import re
+from collections import Counter
+
+from sqlalchemy import (Column, Integer, MetaData, String, Table, Text, cast,
+                        distinct, func, select)
+from sqlalchemy import Index as TableIndex
+
+from .backends import BaseBackend, document_builder
+
+TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+
+class Index(object):
+    '''
+    Inverted index of model which is stored in postings table of database,
+    changes are buffered until commit.
+    '''
+
+    def __init__(self, db, postings, meta, model, name, pk, analyzer):
+        self.db = db
+        self.postings = postings
+        self.meta = meta
+        self.model = model
+        self.name = getattr(model, "__msearch_index__", name)
+        self.pk = getattr(model, "__msearch_primary_key__", pk)
+        self.analyzer = getattr(model, "__msearch_analyzer__", analyzer)
+        self.searchable = set(
+            getattr(
+                model,
+                "__msearch__",
+                getattr(model, "__searchable__", []),
+            ))
+        self._deletes = []
+        self._inserts = []
+        self._document = None
+
+    def after_fork(self):
+        '''
+        changes buffered by parent would be committed by parent
+        '''
+        self._deletes = []
+        self._inserts = []
+
+    @property
+    def fields(self):
+        return sorted(self.searchable)
+
+    @property
+    def document(self):
+        '''
+        compiled document builder, values are tokenized as string
+        '''
+        if self._document is None:
+            self._document = document_builder(
+                self.model, [self.pk] + self.fields)
+        return self._document
+
+    def tokenize(self, value):
+        if self.analyzer is not None:
+            return [getattr(t, "text", t) for t in self.analyzer(value)]
+        return [t.lower() for t in TOKEN_RE.findall(value)]
+
+    def _rows(self, pk, attrs):
+        rows = []
+        for field, value in attrs.items():
+            if value is None:
+                continue
+            for token, tf in Counter(self.tokenize(str(value))).items():
+                rows.append({
+                    "index": self.name,
+                    "token": token[:255],
+                    "pk": pk,
+                    "field": field,
+                    "tf": tf,
+                })
+        return rows
+
+    def create(self, **kwargs):
+        '''
+        existing postings of pk would be replaced
+        '''
+        pk = str(kwargs.pop(self.pk))
+        self._deletes.append((pk, None))
+        self._inserts.extend(self._rows(pk, kwargs))
+
+    def update(self, **kwargs):
+        '''
+        only postings of the given fields would be replaced
+        '''
+        pk = str(kwargs.pop(self.pk))
+        fields = None
+        if set(kwargs) != self.searchable:
+            fields = list(kwargs)
+        self._deletes.append((pk, fields))
+        self._inserts.extend(self._rows(pk, kwargs))
+
+    def delete(self, **kwargs):
+        self._deletes.append((str(kwargs[self.pk]), None))
+
+    def commit(self):
+        p = self.postings
+        deletes, self._deletes = self._deletes, []
+        inserts, self._inserts = self._inserts, []
+        with self.db.engine.begin() as conn:
+            pks = [pk for pk, fields in deletes if fields is None]
+            for i in range(0, len(pks), 500):
+                conn.execute(p.delete().where(
+                    p.c.index == self.name,
+                    p.c.pk.in_(pks[i:i + 500]),
+                ))
+            for pk, fields in deletes:
+                if fields is None:
+                    continue
+                conn.execute(p.delete().where(
+                    p.c.index == self.name,
+                    p.c.pk == pk,
+                    p.c.field.in_(fields),
+                ))
+            if inserts:
+                conn.execute(p.insert(), inserts)
+
+    def get_meta(self, key, default=None):
+        m = self.meta
+        with self.db.engine.connect() as conn:
+            value = conn.execute(
+                select(m.c.value).where(m.c.index == self.name,
+                                        m.c.key == key)).scalar()
+        return default if value is None else json.loads(value)
+
+    def set_meta(self, key, value):
+        m = self.meta
+        with self.db.engine.begin() as conn:
+            conn.execute(
+                m.delete().where(m.c.index == self.name, m.c.key == key))
+            conn.execute(m.insert(), {
+                "index": self.name,
+                "key": key,
+                "value": json.dumps(value, default=str),
+            })
+
+    def search(self, keywords, fields=None, or_=True):
+        '''
+        subquery of (pk, score) which is sum of term frequency
+        '''
+        p = self.postings
+        keywords = set(k[:255] for k in keywords)
+        query = select(
+            p.c.pk.label("pk"),
+            func.sum(p.c.tf).label("score"),
+        ).where(
+            p.c.index == self.name,
+            p.c.token.in_(keywords),
+        ).group_by(p.c.pk)
+        if fields is not None:
+            query = query.where(p.c.field.in_(fields))
+        if not or_:
+            query = query.having(
+                func.count(distinct(p.c.token)) == len(keywords))
+        return query.subquery()
+
+
+class DatabaseSearch(BaseBackend):
+    '''
+    Store inverted index in application database, so that all processes and
+    nodes share the same index without extra service.
+    '''
+    database_index = True
+
+    def init_app(self, app):
+        self._setdefault(app)
+        self._signal_connect(app)
+        app.config.setdefault("MSEARCH_POSTINGS_TABLE", "msearch_postings")
+        if self.analyzer is None:
+            self.analyzer = app.config["MSEARCH_ANALYZER"]
+        self.pk = app.config["MSEARCH_PRIMARY_KEY"]
+        self.index_name = app.config["MSEARCH_INDEX_NAME"]
+
+        name = app.config["MSEARCH_POSTINGS_TABLE"]
+        self.metadata = MetaData()
+        self.postings = Table(
+            name,
+            self.metadata,
+            Column("index", String(64), primary_key=True),
+            Column("token", String(255), primary_key=True),
+            Column("pk", String(64), primary_key=True),
+            Column("field", String(64), primary_key=True),
+            Column("tf", Integer, nullable=False),
+            # lookup by pk when updating, deleting and reconciling
+            TableIndex(name + "_pk", "index", "pk", "field"),
+        )
+        self.meta = Table(
+            name + "_meta",
+            self.metadata,
+            Column("index", String(64), primary_key=True),
+            Column("key", String(64), primary_key=True),
+            Column("value", Text),
+        )
+        self._created = False
+        super(DatabaseSearch, self).init_app(app)
+
+    def index(self, model):
+        '''
+        get index
+        '''
+        if not self._created:
+            self.metadata.create_all(self.db.engine)
+            self._created = True
+        name = model.__table__.name
+        if name not in self._indexs:
+            self._indexs[name] = Index(
+                self.db,
+                self.postings,
+                self.meta,
+                model,
+                name,
+                self.pk,
+                self.analyzer,
+            )
+        return self._indexs[name]
+
+    def _document(self, index, instance):
+        return index.document(instance)
+
+    def create_one_index(self,
+                         instance,
+                         update=False,
+                         delete=False,
+                         commit=True):
+        if update and delete:
+            raise ValueError("update and delete can't work togther")
+        ix = self.index(instance.__class__)
+        if delete:
+            self.logger.debug('deleting index: {}'.format(instance))
+            ix.delete(**{ix.pk: getattr(instance, ix.pk)})
+        elif update:
+            self.logger.debug('updating index: {}'.format(instance))
+            ix.update(**self._document(ix, instance))
+        else:
+            self.logger.debug('creating index: {}'.format(instance))
+            ix.create(**self._document(ix, instance))
+        if commit:
+            ix.commit()
+        return instance
+
+    def _index_pks(self, index, batch_size=500):
+        p = self.postings
+        query = select(p.c.pk).where(p.c.index == index.name).group_by(
+            p.c.pk).order_by(p.c.pk).limit(batch_size)
+        last = None
+        while True:
+            chunk = query
+            if last is not None:
+                chunk = chunk.where(p.c.pk > last)
+            with self.db.engine.connect() as conn:
+                pks = conn.execute(chunk).scalars().all()
+            if not pks:
+                break
+            for pk in pks:
+                yield pk
+            last = pks[-1]
+
+    def _delete_pks(self, index, pks):
+        for pk in pks:
+            index.delete(**{index.pk: pk})
+
+    def _fields(self, index, attr):
+        return attr
+
+    def msearch(self, m, query, fields=None, limit=None, or_=True):
+        ix = self.index(m)
+        keywords = [k for k in ix.tokenize(query) if k]
+        column = getattr(m, ix.pk)
+        if not keywords:
+            return m.query.filter(False)
+        hits = ix.search(keywords, fields, or_)
+        results = m.query.join(
+            hits,
+            cast(hits.c.pk, column.type) == column,
+        ).order_by(hits.c.score.desc(), column)
+        if limit is not None:
+            results = results.limit(limit)
+        return results
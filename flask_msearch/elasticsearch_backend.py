@@ -1,15 +1,27 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import copy
+import re
+from contextlib import contextmanager
 
 from sqlalchemy import types
 from elasticsearch import Elasticsearch
-from .backends import BaseBackend, BaseSchema, relation_column, get_mapper
-import sqlalchemy
+from elasticsearch.helpers import BulkIndexError, parallel_bulk, streaming_bulk
+from .backends import (BaseBackend, BaseSchema, Hit, Pagination, RankedQuery,
+                       document_builder, get_mapper, hits_query)
+
+# elasticsearch client serializes date and datetime by itself
+CONVERTERS = {
+    "date": lambda value: value,
+    "long": int,
+    "float": float,
+    "boolean": bool,
+}
 
 
 class Schema(BaseSchema):
     def fields_map(self, field_type):
-        if field_type == "primary":
+        if field_type in ("primary", "keyword"):
             return {'type': 'keyword'}
 
         type_map = {
@@ -18,7 +30,7 @@ class Schema(BaseSchema):
             'boolean': types.Boolean,
             'integer': types.Integer,
             'float': types.Float,
-            'binary': types.Binary
+            'binary': types.LargeBinary
         }
         if isinstance(field_type, str):
             field_type = type_map.get(field_type, types.Text)
@@ -34,18 +46,32 @@ class Schema(BaseSchema):
             return {'type': 'float'}
         elif issubclass(field_type, types.Boolean):
             return {'type': 'boolean'}
-        elif issubclass(field_type, types.Binary):
+        elif issubclass(field_type, types.LargeBinary):
             return {'type': 'binary'}
-        return {'type': 'string'}
+        return {'type': 'text'}
 
 
 # https://medium.com/@federicopanini/elasticsearch-6-0-removal-of-mapping-types-526a67ff772
 class Index(object):
-    def __init__(self, client, model, doc_type, pk, name):
+    def __init__(self,
+                 client,
+                 model,
+                 doc_type,
+                 pk,
+                 name,
+                 bulk_options=None,
+                 settings=None):
         '''
         global index name do nothing, must create different index name
+
+        :param settings: settings of index such as number_of_shards
         '''
         self._client = client
+        self._actions = []
+        self._changed = set()
+        self.generation = 0
+        self.bulk_options = bulk_options or dict()
+        self.settings = settings or dict()
         self.model = model
         self.doc_type = getattr(
             model,
@@ -64,26 +90,276 @@ class Index(object):
                 getattr(model, "__searchable__", []),
             ))
         self.name = self.doc_type
+        self._schema = Schema(self)
+        self._document = None
         self.init()
 
+    @property
+    def document(self):
+        "Compiled document builder of searchable fields."
+        if self._document is None:
+            fields = self._schema.fields
+            self._document = document_builder(
+                self.model,
+                sorted(self.searchable),
+                {
+                    name: CONVERTERS.get(fields[name].get("type"), str)
+                    for name in self.searchable
+                },
+            )
+        return self._document
+
+    @property
+    def body(self):
+        "Settings and explicit mappings of searchable fields."
+        body = {
+            "mappings": {
+                self.doc_type: {
+                    "properties": self._schema.fields
+                }
+            }
+        }
+        if self.settings:
+            body["settings"] = {"index": self.settings}
+        return body
+
     def init(self):
+        '''
+        Create the first version of index and use index name as alias, so
+        that it can be rebuilt without downtime.
+        '''
         if not self._client.indices.exists(index=self.name):
-            self._client.indices.create(index=self.name)
+            body = self.body
+            body["aliases"] = {self.name: {}}
+            self._client.indices.create(
+                index=self.version_name(1), body=body)
+
+    def version_name(self, version):
+        return "{}_v{}".format(self.name, version)
+
+    def versions(self):
+        "Versions of index, sorted from old to new."
+        pattern = re.compile(r"^{}_v(\d+)$".format(re.escape(self.name)))
+        indices = self._client.indices.get(
+            index=self.name + "_v*", ignore=[404])
+        versions = []
+        for name in indices:
+            match = pattern.match(name)
+            if match is not None:
+                versions.append(int(match.group(1)))
+        return sorted(versions)
+
+    def create_version(self):
+        '''
+        Create a new version of index with bulk loading settings, return
+        a copy of index which writes documents into the new version.
+        '''
+        versions = self.versions()
+        name = self.version_name(versions[-1] + 1 if versions else 1)
+        body = self.body
+        body.setdefault("settings", {}).setdefault("index", {}).update({
+            "refresh_interval": "-1",
+            "number_of_replicas": 0,
+        })
+        self._client.indices.create(index=name, body=body)
+        version = copy.copy(self)
+        version.name = name
+        version._actions = []
+        version._changed = set()
+        return version
+
+    def swap(self, version, keep=2):
+        '''
+        Point alias to the new version atomically, and delete old versions
+        except the latest keep versions.
+        '''
+        self._client.indices.put_settings(
+            index=version.name,
+            body={
+                "index": {
+                    "refresh_interval": None,
+                    "number_of_replicas": self.settings.get(
+                        "number_of_replicas", 1),
+                }
+            })
+        self._client.indices.refresh(index=version.name)
+        # keep watermark and checkpoint of incremental updates
+        meta = self._meta()
+        if meta:
+            self._client.indices.put_mapping(
+                index=version.name,
+                doc_type=self.doc_type,
+                body={"_meta": meta})
+
+        actions = [{"add": {"index": version.name, "alias": self.name}}]
+        if self._client.indices.exists_alias(name=self.name):
+            aliases = self._client.indices.get_alias(name=self.name)
+            actions.extend({
+                "remove": {
+                    "index": name,
+                    "alias": self.name
+                }
+            } for name in aliases if name != version.name)
+        elif self._client.indices.exists(index=self.name):
+            # index created before versioning, alias can't share its name
+            actions.append({"remove_index": {"index": self.name}})
+        self._client.indices.update_aliases(body={"actions": actions})
+        self.generation += 1
+
+        for old in self.versions()[:-keep]:
+            self._client.indices.delete(
+                index=self.version_name(old), ignore=[404])
+
+    @property
+    def journal_name(self):
+        return "{}_journal".format(self.doc_type)
+
+    def start_journal(self):
+        '''
+        primary keys of documents changed by all processes are indexed into
+        journal until stop_journal
+        '''
+        self._client.indices.delete(index=self.journal_name, ignore=[404])
+        self._client.indices.create(
+            index=self.journal_name,
+            body={"mappings": {
+                self.doc_type: {
+                    "enabled": False
+                }
+            }})
+
+    def stop_journal(self):
+        self._client.indices.delete(index=self.journal_name, ignore=[404])
+
+    def _record(self, pk):
+        # versions written by rebuild are not journaled
+        if self.name == self.doc_type:
+            self._changed.add(str(pk))
+
+    def _journal(self, pks):
+        # journal is not created by writers
+        if not self._client.indices.exists(index=self.journal_name):
+            return
+        self.bulk({
+            "_op_type": "index",
+            "_index": self.journal_name,
+            "_type": self.doc_type,
+            "_id": pk,
+            "_source": {},
+        } for pk in pks)
+
+    def read_journal(self, batch_size=500):
+        '''
+        read primary keys of journal, return {pk: version of journal}
+        '''
+        if not self._client.indices.exists(index=self.journal_name):
+            return dict()
+        self._client.indices.refresh(index=self.journal_name)
+        body = {
+            "query": {
+                "match_all": {}
+            },
+            "sort": [{
+                "_id": "asc"
+            }],
+            "version": True,
+            "size": batch_size,
+        }
+        pks = dict()
+        while True:
+            hits = self._client.search(
+                index=self.journal_name, body=body)["hits"]["hits"]
+            if not hits:
+                return pks
+            for hit in hits:
+                pks[hit["_id"]] = hit["_version"]
+            body["search_after"] = hits[-1]["sort"]
+
+    def trim_journal(self, pks):
+        '''
+        delete primary keys which have been replayed, keys which are journaled
+        again meanwhile are kept by version conflict
+        '''
+        success, errors = self.bulk({
+            "_op_type": "delete",
+            "_index": self.journal_name,
+            "_type": self.doc_type,
+            "_id": pk,
+            "_version": version,
+        } for pk, version in pks.items())
+        errors = [
+            error for error in errors
+            if list(error.values())[0].get("status") != 409
+        ]
+        if errors:
+            raise BulkIndexError(
+                "%i document(s) failed to index." % len(errors), errors)
+
+    @contextmanager
+    def bulk_loading(self):
+        '''
+        Disable refresh and replicas while loading documents, and restore
+        them afterwards.
+        '''
+        settings = self._client.indices.get_settings(index=self.name)
+        settings = list(settings.values())[0]["settings"]["index"]
+        self._client.indices.put_settings(
+            index=self.name,
+            body={"index": {
+                "refresh_interval": "-1",
+                "number_of_replicas": 0,
+            }})
+        try:
+            yield self
+        finally:
+            # null resets refresh_interval to default
+            self._client.indices.put_settings(
+                index=self.name,
+                body={
+                    "index": {
+                        "refresh_interval": settings.get("refresh_interval"),
+                        "number_of_replicas": settings["number_of_replicas"],
+                    }
+                })
+            self._client.indices.refresh(index=self.name)
+
+    def _meta(self):
+        "Get _meta of index mapping."
+        mapping = self._client.indices.get_mapping(
+            index=self.name, ignore=[404])
+        for value in mapping.values():
+            meta = value.get("mappings", {}).get(self.doc_type, {})
+            return meta.get("_meta", {})
+        return dict()
+
+    def get_meta(self, key, default=None):
+        "Get value from _meta of index mapping."
+        return self._meta().get(key, default)
+
+    def set_meta(self, key, value):
+        "Set value to _meta of index mapping."
+        meta = self._meta()
+        meta[key] = value
+        return self._client.indices.put_mapping(
+            index=self.name, doc_type=self.doc_type, body={"_meta": meta})
 
     def create(self, **kwargs):
         "Create document not create index."
+        self._record(kwargs[self.pk])
         kw = dict(index=self.name, doc_type=self.doc_type)
         kw.update(**kwargs)
         return self._client.index(**kw)
 
     def update(self, **kwargs):
         "Update document not update index."
+        self._record(kwargs[self.pk])
         kw = dict(index=self.name, doc_type=self.doc_type, ignore=[404])
         kw.update(**kwargs)
         return self._client.update(**kw)
 
     def delete(self, **kwargs):
         "Delete document not delete index."
+        self._record(kwargs[self.pk])
         kw = dict(index=self.name, doc_type=self.doc_type, ignore=[404])
         kw.update(**kwargs)
         return self._client.delete(**kw)
@@ -93,7 +369,81 @@ class Index(object):
         kw.update(**kwargs)
         return self._client.search(**kw)
 
+    def action(self, op_type, pk, attrs=None):
+        "Make bulk action of document."
+        action = {
+            "_op_type": op_type,
+            "_index": self.name,
+            "_type": self.doc_type,
+            "_id": pk,
+        }
+        if op_type == "index":
+            action["_source"] = attrs
+        elif op_type == "update":
+            # document which isn't indexed yet is created, such as rows
+            # inserted since watermark of incremental update
+            action["doc"] = attrs
+            action["doc_as_upsert"] = True
+        return action
+
+    def bulk(self, actions):
+        '''
+        Send actions with bulk api in streaming chunks.
+        :return: count of success actions and list of failed items
+        '''
+        if self.name == self.doc_type:
+            actions = self._recorded(actions)
+        options = dict(self.bulk_options)
+        thread_count = options.pop("thread_count", 1)
+        options.setdefault("raise_on_error", False)
+        if thread_count > 1:
+            results = parallel_bulk(
+                self._client, actions, thread_count=thread_count, **options)
+        else:
+            results = streaming_bulk(self._client, actions, **options)
+
+        success, errors = 0, []
+        for ok, item in results:
+            if ok:
+                success += 1
+                continue
+            op_type, info = list(item.items())[0]
+            # same as ignore=[404] when update or delete document
+            if op_type in ("update", "delete") and info.get("status") == 404:
+                continue
+            errors.append(item)
+        return success, errors
+
+    def _recorded(self, actions):
+        for action in actions:
+            if action["_index"] == self.name:
+                self._record(action["_id"])
+            yield action
+
+    def queue(self, action):
+        "Queue action until commit, send it when queue is full."
+        self._actions.append(action)
+        if len(self._actions) >= self.bulk_options.get("chunk_size", 500):
+            self.flush()
+        return action
+
+    def flush(self):
+        if not self._actions:
+            return
+        actions, self._actions = self._actions, []
+        success, errors = self.bulk(actions)
+        if errors:
+            raise BulkIndexError(
+                "%i document(s) failed to index." % len(errors), errors)
+        return success
+
     def commit(self):
+        self.flush()
+        changed, self._changed = self._changed, set()
+        if changed:
+            self._journal(changed)
+        # only changes of current process can be seen by search cache
+        self.generation += 1
         return self._client.indices.refresh(index=self.name)
 
 
@@ -101,11 +451,37 @@ class ElasticSearch(BaseBackend):
     def init_app(self, app):
         self._setdefault(app)
         self._signal_connect(app)
+        app.config.setdefault("MSEARCH_BULK_CHUNK_SIZE", 500)
+        app.config.setdefault("MSEARCH_BULK_MAX_BYTES", 100 * 1024 * 1024)
+        app.config.setdefault("MSEARCH_BULK_THREADS", 1)
+        app.config.setdefault("MSEARCH_BULK_LOADING", True)
+        app.config.setdefault("MSEARCH_ES_SHARDS", None)
+        app.config.setdefault("MSEARCH_ES_REPLICAS", None)
         self._client = Elasticsearch(**app.config.get('ELASTICSEARCH', {}))
         self.pk = app.config["MSEARCH_PRIMARY_KEY"]
         self.index_name = app.config["MSEARCH_INDEX_NAME"]
+        self.bulk_options = {
+            "chunk_size": app.config["MSEARCH_BULK_CHUNK_SIZE"],
+            "max_chunk_bytes": app.config["MSEARCH_BULK_MAX_BYTES"],
+            "thread_count": app.config["MSEARCH_BULK_THREADS"],
+        }
+        self.settings = dict()
+        if app.config["MSEARCH_ES_SHARDS"] is not None:
+            self.settings["number_of_shards"] = app.config["MSEARCH_ES_SHARDS"]
+        if app.config["MSEARCH_ES_REPLICAS"] is not None:
+            self.settings["number_of_replicas"] = app.config[
+                "MSEARCH_ES_REPLICAS"]
         super(ElasticSearch, self).init_app(app)
 
+    def after_fork(self):
+        "Connections of parent can't be shared with child."
+        self._client = Elasticsearch(
+            **self.app.config.get('ELASTICSEARCH', {}))
+        for ix in self._indexs.values():
+            ix._client = self._client
+            ix._actions = []
+        super(ElasticSearch, self).after_fork()
+
     @property
     def indices(self):
         return self._client.indices
@@ -115,30 +491,158 @@ class ElasticSearch(BaseBackend):
                          update=False,
                          delete=False,
                          commit=True):
+        '''
+        :param commit: when commit is False, the document would be queued and
+                       sent with bulk api by index.commit()
+        '''
         if update and delete:
             raise ValueError("update and delete can't work togther")
         ix = self.index(instance.__class__)
+        if not commit:
+            return ix.queue(self._action(ix, instance, update, delete))
+
         pk = ix.pk
         pkv = getattr(instance, pk)
-        attrs = dict()
-        for field in ix.searchable:
-            if '.' in field:
-                attrs[field] = str(relation_column(instance, field.split('.')))
-            else:
-                attrs[field] = str(getattr(instance, field))
         if delete:
             self.logger.debug('deleting index: {}'.format(instance))
             r = ix.delete(**{pk: pkv})
         elif update:
             self.logger.debug('updating index: {}'.format(instance))
-            r = ix.update(**{pk: pkv, "body": {"doc": attrs}})
+            attrs = self._attrs(ix, instance)
+            r = ix.update(**{
+                pk: pkv,
+                "body": {
+                    "doc": attrs,
+                    "doc_as_upsert": True
+                }
+            })
         else:
             self.logger.debug('creating index: {}'.format(instance))
+            attrs = self._attrs(ix, instance)
             r = ix.create(**{pk: pkv, "body": attrs})
-        if commit:
-            ix.commit()
+        ix.commit()
         return r
 
+    def create_index(self,
+                     model='__all__',
+                     update=False,
+                     delete=False,
+                     yield_per=100,
+                     chunk_size=None,
+                     resume=False,
+                     rebuild=False):
+        '''
+        Use bulk loading settings when loading all rows of model, update of
+        live index is not affected.
+        '''
+        create_index = super(ElasticSearch, self).create_index
+        if (model == '__all__' or update or delete or rebuild
+                or not self.app.config["MSEARCH_BULK_LOADING"]):
+            return create_index(model, update, delete, yield_per, chunk_size,
+                                resume, rebuild)
+        with self.index(model).bulk_loading():
+            return create_index(model, update, delete, yield_per, chunk_size,
+                                resume)
+
+    def _rebuild_index(self, index, yield_per=100):
+        '''
+        Index all rows into a new version, then swap alias to it, documents
+        changed by other processes meanwhile are replayed.
+        '''
+        version = index.create_version()
+        # writers see journal before rows are read
+        index.start_journal()
+        try:
+            instances = self._index_query(index).yield_per(yield_per)
+            success, errors = version.bulk(
+                self._action(version, instance) for instance in instances)
+            if errors:
+                # don't swap alias to an incomplete index
+                raise BulkIndexError(
+                    "%i document(s) failed to index." % len(errors), errors)
+            self._replay(index, version)
+        except Exception:
+            index.stop_journal()
+            self._client.indices.delete(index=version.name, ignore=[404])
+            raise
+        index.swap(version, self.app.config["MSEARCH_KEEP_VERSIONS"])
+        # changes sent to old version before alias is switched
+        self._replay(index, version)
+        index.stop_journal()
+        return index
+
+    def _replay(self, index, version):
+        '''
+        reindex documents of journal into version until no more changes
+        '''
+        while True:
+            pks = index.read_journal()
+            if not pks:
+                return
+            missing = set(pks)
+            actions = []
+            for instance in self._instances(index, pks):
+                missing.discard(str(getattr(instance, index.pk)))
+                actions.append(self._action(version, instance))
+            actions.extend(version.action("delete", pk) for pk in missing)
+            success, errors = version.bulk(actions)
+            if errors:
+                raise BulkIndexError(
+                    "%i document(s) failed to index." % len(errors), errors)
+            self._client.indices.refresh(index=version.name)
+            index.trim_journal(pks)
+
+    def create_many_index(self, index, instances, update=False, delete=False):
+        '''
+        Use bulk api instead of one request per document
+        '''
+        if update and delete:
+            raise ValueError("update and delete can't work togther")
+        success, errors = index.bulk(
+            self._action(index, instance, update, delete)
+            for instance in instances)
+        for error in errors:
+            self.logger.warning('bulk index error: {}'.format(error))
+        self.logger.info('bulk index {}: {} success, {} errors'.format(
+            index.name, success, len(errors)))
+        return index
+
+    def _index_pks(self, index, batch_size=500):
+        "Page all document ids with search_after instead of scroll."
+        body = {
+            "query": {
+                "match_all": {}
+            },
+            "sort": [{
+                "_id": "asc"
+            }],
+            "_source": False,
+            "size": batch_size,
+        }
+        while True:
+            hits = index.search(body=body)["hits"]["hits"]
+            if not hits:
+                break
+            for hit in hits:
+                yield hit["_id"]
+            body["search_after"] = hits[-1]["sort"]
+
+    def _delete_pks(self, index, pks):
+        for pk in pks:
+            index.queue(index.action("delete", pk))
+
+    def _attrs(self, index, instance):
+        return index.document(instance)
+
+    def _action(self, index, instance, update=False, delete=False):
+        pkv = getattr(instance, index.pk)
+        if delete:
+            return index.action("delete", pkv)
+        attrs = self._attrs(index, instance)
+        if update:
+            return index.action("update", pkv, attrs)
+        return index.action("index", pkv, attrs)
+
     def index(self, model):
         '''
         Elasticsearch multi types has been removed
@@ -153,6 +657,8 @@ class ElasticSearch(BaseBackend):
                 name,
                 self.pk,
                 self.index_name,
+                self.bulk_options,
+                self.settings,
             )
         return self._indexs[name]
 
@@ -162,45 +668,89 @@ class ElasticSearch(BaseBackend):
     def msearch(self, m, query=None):
         return self.index(m).search(body=query)
 
+    def _hits(self,
+              m,
+              query,
+              fields=None,
+              limit=None,
+              or_=False,
+              page=None,
+              per_page=20,
+              **kwargs):
+        # https://www.elastic.co/guide/en/elasticsearch/reference/current/query-dsl-query-string-query.html
+        ix = self.index(m)
+        query_string = {
+            "fields": fields or list(ix.searchable),
+            "query": query,
+            "default_operator": "OR" if or_ else "AND",
+            "analyze_wildcard": True
+        }
+        query_string.update(**kwargs)
+        query = {
+            "query": {
+                "query_string": query_string
+            },
+            "size": limit or -1,
+        }
+        offset = 0
+        if page is not None:
+            offset = (page - 1) * per_page
+            query.update({"from": offset, "size": per_page})
+        results = self.msearch(m, query)['hits']
+        hits = [
+            Hit(r["_id"], offset + index, r["_score"], r.get("_source"))
+            for index, r in enumerate(results['hits'])
+        ]
+        total = results['total']
+        # total is object since elasticsearch 7.0
+        if isinstance(total, dict):
+            total = total['value']
+        return total, hits
+
     def _query_class(self, q):
         _self = self
 
-        class Query(q):
+        class Query(RankedQuery, q):
             def msearch(self,
                         query,
                         fields=None,
                         limit=None,
                         or_=False,
                         rank_order=False,
+                        page=None,
+                        per_page=20,
                         **kwargs):
+                '''
+                when page is not None, only hits of the page would be queried
+                from database, and return pagination instead of query.
+                '''
                 model = get_mapper(self).class_
-                # https://www.elastic.co/guide/en/elasticsearch/reference/current/query-dsl-query-string-query.html
                 ix = _self.index(model)
-                query_string = {
-                    "fields": fields or list(ix.searchable),
-                    "query": query,
-                    "default_operator": "OR" if or_ else "AND",
-                    "analyze_wildcard": True
-                }
-                query_string.update(**kwargs)
-                query = {
-                    "query": {
-                        "query_string": query_string
-                    },
-                    "size": limit or -1,
-                }
-                results = _self.msearch(model, query)['hits']['hits']
-                if not results:
-                    return self.filter(False)
-                result_set = set()
-                for i in results:
-                    result_set.add(i["_id"])
-                result_query = self.filter(getattr(model, ix.pk).in_(result_set))
-                if rank_order:
-                    result_query = result_query.order_by(
-                        sqlalchemy.sql.expression.case(
-                            {r["_id"]: index for index, r in enumerate(results)},
-                            value=getattr(model, ix.pk)))
-                return result_query
+                total, results = _self._search_hits(
+                    model,
+                    query,
+                    fields,
+                    limit,
+                    or_,
+                    page,
+                    per_page,
+                    **kwargs,
+                )
+                result_query = hits_query(
+                    self,
+                    getattr(model, ix.pk),
+                    results,
+                    rank_order,
+                    _self.app.config["MSEARCH_RANK_CASE_LIMIT"],
+                )
+                if page is None:
+                    return result_query
+                return Pagination(
+                    result_query,
+                    page,
+                    per_page,
+                    total,
+                    result_query.all() if results else [],
+                )
 
         return Query
@@ -1,5 +1,17 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import atexit
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy.inspection import inspect
+from sqlalchemy.orm import RelationshipProperty
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 
 def default_signal(backend, sender, changes):
@@ -24,26 +36,343 @@ def default_signal(backend, sender, changes):
          return celery_signal_task.delay(backend, sender, changes)
     ```
     '''
+    targets = _related_targets(backend, changes)
+    indexs = OrderedDict()
+    for ix, pk, instance, operation in _operations(backend, changes):
+        operations = indexs.setdefault(ix.name, (ix, OrderedDict()))[1]
+        _coalesce(operations, str(pk), (instance, operation))
+    _apply_operations(backend, indexs)
+
+    if not targets:
+        return
+    # no more SQL can be emitted by the committed session
+    session = backend.db.session.session_factory()
+    try:
+        for ix, pks in _related_pks(backend, targets, session):
+            # skip documents which have been reindexed entirely
+            done = indexs.get(ix.name, (ix, dict()))[1]
+            pks = [
+                pk for pk in pks
+                if done.get(str(pk), (None, 'attrs'))[1] == 'attrs'
+            ]
+            if not pks:
+                continue
+            instances = backend._index_query(ix, session).filter(
+                getattr(ix.model, ix.pk).in_(pks))
+            backend.create_many_index(ix, instances, update=True)
+            ix.commit()
+    finally:
+        session.close()
+
+
+def _primary_key(index, instance):
+    '''
+    get primary key without refreshing expired instance after commit
+    '''
+    state = inspect(instance)
+    if index.pk in state.dict:
+        return state.dict[index.pk]
+    keys = [
+        state.mapper.get_property_by_column(column).key
+        for column in state.mapper.primary_key
+    ]
+    if state.identity is not None and keys == [index.pk]:
+        return state.identity[0]
+    return getattr(instance, index.pk)
+
+
+def record_changes(session, flush_context=None, instances=None):
+    '''
+    before_flush listener, history of attributes is reset after commit, so
+    record the modified attributes in InstanceState.info before flush.
+    '''
+    for instance in session.dirty:
+        state = inspect(instance)
+        changed = [
+            key for key in state.committed_state
+            if state.attrs[key].history.has_changes()
+        ]
+        state.info.setdefault("msearch_changed", set()).update(changed)
+
+
+def _dependencies(index):
+    '''
+    attributes of model which searchable fields depend on, return None if
+    a field isn't mapped attribute such as hybrid_property
+    '''
+    mapper = inspect(index.model)
+    keys = set([index.pk])
+    for field in index.searchable:
+        prop = mapper.attrs.get(field.split('.')[0])
+        if prop is None:
+            return
+        keys.add(prop.key)
+        if isinstance(prop, RelationshipProperty):
+            keys.update(
+                mapper.get_property_by_column(column).key
+                for column in prop.local_columns
+                if column in mapper.columns.values())
+    return keys
+
+
+def _searchable_changed(index, instance):
+    changed = inspect(instance).info.pop("msearch_changed", None)
+    if changed is None:
+        return True
+    keys = _dependencies(index)
+    return keys is None or bool(changed & keys)
+
+
+def reverse_dependencies(backend):
+    '''
+    infer {related model: [(model, relationship, attributes)]} from dotted
+    searchable fields such as tag.name
+    '''
+    from .backends import get_tables
+
+    models = [
+        m for m in get_tables(backend.db.Model)
+        if hasattr(m, "__searchable__") or hasattr(m, "__msearch__")
+    ]
+    if backend._dependencies is not None and backend._dependencies[
+            0] == models:
+        return backend._dependencies[1]
+
+    dependencies = dict()
+    for model in models:
+        relations = OrderedDict()
+        fields = getattr(model, "__msearch__",
+                         getattr(model, "__searchable__", []))
+        for field in fields:
+            if '.' not in field:
+                continue
+            key, attr = field.split('.')[:2]
+            prop = inspect(model).attrs.get(key)
+            if not isinstance(prop, RelationshipProperty):
+                continue
+            relations.setdefault(prop, set()).add(attr)
+        for prop, attrs in relations.items():
+            dependencies.setdefault(prop.mapper.class_, []).append(
+                (model, prop, attrs))
+    backend._dependencies = (models, dependencies)
+    return dependencies
+
+
+def _related_targets(backend, changes):
+    '''
+    group primary keys of updated related instances by (model, relationship)
+    '''
+    dependencies = reverse_dependencies(backend)
+    targets = OrderedDict()
+    for change in changes:
+        instance = change[0]
+        if change[1] != 'update' or instance.__class__ not in dependencies:
+            continue
+        state = inspect(instance)
+        changed = state.info.get("msearch_changed")
+        for model, prop, attrs in dependencies[instance.__class__]:
+            if changed is not None and not changed & attrs:
+                continue
+            if state.identity is None:
+                continue
+            targets.setdefault((model, prop), set()).add(state.identity[0])
+    return targets
+
+
+def _related_pks(backend, targets, session, chunk_size=500):
+    '''
+    yield (index, pks) of documents which refer to related instances, pks of
+    each relationship are queried at once and yield in batches.
+    '''
+    batch_size = backend.app.config["MSEARCH_RELATED_BATCH_SIZE"]
+    for (model, prop), ids in targets.items():
+        ix = backend.index(model)
+        column = getattr(model, ix.pk)
+        related = prop.mapper.primary_key[0]
+        ids = list(ids)
+        pks = []
+        for i in range(0, len(ids), chunk_size):
+            rows = session.query(column).join(
+                getattr(model, prop.key)).filter(
+                    related.in_(ids[i:i + chunk_size])).distinct().all()
+            pks.extend(row[0] for row in rows)
+        backend.metrics["related_indexed"] += len(pks)
+        for i in range(0, len(pks), batch_size):
+            yield ix, pks[i:i + batch_size]
+
+
+def _operations(backend, changes):
+    '''
+    yield (index, pk, instance or attrs, operation) of changes, updates that
+    no searchable field changed are skipped.
+    '''
     for change in changes:
         instance = change[0]
         operation = change[1]
         if hasattr(instance, '__searchable__'):
-            if operation == 'insert':
-                backend.create_one_index(instance)
-            elif operation == 'update':
-                backend.create_one_index(instance, update=True)
-            elif operation == 'delete':
-                backend.create_one_index(instance, delete=True)
+            ix = backend.index(instance.__class__)
+            if operation == 'update' and not _searchable_changed(
+                    ix, instance):
+                backend.metrics["update_skipped"] += 1
+            else:
+                if operation == 'update':
+                    backend.metrics["update_indexed"] += 1
+                yield ix, _primary_key(ix, instance), instance, operation
 
         delete = True if operation == 'delete' else False
         prepare = [i for i in dir(instance) if i.startswith('msearch_')]
         for p in prepare:
             attrs = getattr(instance, p)(delete=delete)
             ix = backend.index(attrs.pop('_index'))
-            if attrs['attrs']:
-                for attr in attrs['attrs']:
-                    ix.update(**backend._fields(ix, attr))
-                ix.commit()
+            for attr in attrs['attrs']:
+                yield ix, attr[ix.pk], attr, 'attrs'
+
+
+def _coalesce(operations, key, item):
+    '''
+    keep only the last operation of each document, except that insert isn't
+    replaced by a later update, because the document may not exist in index
+    yet, and update isn't replaced by attrs which only contain some fields.
+    '''
+    previous = operations.get(key)
+    if previous is not None:
+        kept = {'insert': ('update', 'attrs'), 'update': ('attrs', )}
+        if item[-1] in kept.get(previous[-1], ()):
+            return
+    operations[key] = item
+
+
+def _apply_operations(backend, indexs):
+    '''
+    indexs is grouped by index and operations of each document are coalesced,
+    because whoosh can't update a document twice within one writer.
+    apply all changes through one writer, and commit once per index.
+    '''
+    for ix, operations in indexs.values():
+        for instance, operation in operations.values():
+            if operation == 'insert':
+                backend.create_one_index(instance, commit=False)
+            elif operation == 'update':
+                backend.create_one_index(instance, update=True, commit=False)
+            elif operation == 'delete':
+                backend.create_one_index(instance, delete=True, commit=False)
+            elif operation == 'attrs':
+                ix.update(**backend._fields(ix, instance))
+        ix.commit()
+
+
+class IndexQueue(object):
+    '''
+    Update index in a background thread, changes of the same document are
+    coalesced as default_signal does.
+    '''
+
+    def __init__(self, backend, maxsize=10000, batch_size=500, interval=1.0):
+        self.backend = backend
+        self.batch_size = batch_size
+        self.interval = interval
+        self._queue = queue.Queue(maxsize)
+        self._thread = threading.Thread(target=self.run)
+        self._thread.daemon = True
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def put(self, index, pk, instance, operation):
+        "Block when queue is full"
+        self._queue.put((index, pk, instance, operation))
+
+    def join(self):
+        "Block until all changes have been indexed"
+        self._queue.join()
+
+    def stop(self, timeout=None):
+        "Index remaining changes and stop worker thread"
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join(timeout)
+
+    def run(self):
+        stopped = False
+        while not stopped:
+            items = OrderedDict()
+            count = 0
+            deadline = time.time() + self.interval
+            while len(items) < self.batch_size:
+                try:
+                    item = self._queue.get(
+                        timeout=max(deadline - time.time(), 0))
+                except queue.Empty:
+                    break
+                count += 1
+                if item is None:
+                    stopped = True
+                    break
+                _coalesce(items, (item[0].name, str(item[1])), item)
+            if items:
+                self.flush(items.values())
+            for _ in range(count):
+                self._queue.task_done()
+
+    def flush(self, items):
+        backend = self.backend
+        try:
+            with backend.app.app_context():
+                # instance can't be shared with request thread, so reload
+                # instances of each index with one query
+                pks = OrderedDict()
+                for ix, pk, instance, operation in items:
+                    if operation in ('insert', 'update'):
+                        pks.setdefault(ix.name, (ix, []))[1].append(pk)
+                instances = dict()
+                for ix, values in pks.values():
+                    query = backend._index_query(ix).filter(
+                        getattr(ix.model, ix.pk).in_(values))
+                    for instance in query:
+                        instances[(ix.name,
+                                   str(getattr(instance, ix.pk)))] = instance
+
+                indexs = OrderedDict()
+                for ix, pk, instance, operation in items:
+                    if operation in ('insert', 'update'):
+                        instance = instances.get((ix.name, str(pk)))
+                        if instance is None:
+                            continue
+                    indexs.setdefault(ix.name, (ix, OrderedDict()))[1][str(
+                        pk)] = (instance, operation)
+                _apply_operations(backend, indexs)
+        except Exception:
+            backend.logger.exception('index queue error')
+
+
+def queue_signal(backend, sender, changes):
+    '''
+    Update index in built-in background thread instead of request:
+    ```
+     app.config["MSEARCH_INDEX_SIGNAL"] = "flask_msearch.signal.queue_signal"
+    ```
+    '''
+    if backend._queue is None:
+        config = backend.app.config
+        backend._queue = IndexQueue(
+            backend,
+            config["MSEARCH_QUEUE_SIZE"],
+            config["MSEARCH_QUEUE_BATCH_SIZE"],
+            config["MSEARCH_QUEUE_INTERVAL"],
+        )
+    targets = _related_targets(backend, changes)
+    for ix, pk, instance, operation in _operations(backend, changes):
+        if operation in ('insert', 'update'):
+            instance = None
+        backend._queue.put(ix, pk, instance, operation)
+    if not targets:
+        return
+    session = backend.db.session.session_factory()
+    try:
+        for ix, pks in _related_pks(backend, targets, session):
+            for pk in pks:
+                backend._queue.put(ix, pk, None, 'update')
+    finally:
+        session.close()
 
 
 def celery_signal(backend, sender, changes):
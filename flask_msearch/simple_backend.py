@@ -1,20 +1,237 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import re
 
 from sqlalchemy import or_ as _or
 from sqlalchemy import and_ as _and
+from sqlalchemy import func, literal_column, text, types
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import ColumnProperty
+from sqlalchemy.sql import column, table
 from .backends import BaseBackend
 
+UNSUPPORTED_RE = re.compile(r"no such (module: fts5|tokenizer: trigram)")
+
+
+class Index(object):
+    '''
+    Sqlite FTS5 shadow table of model, which is synchronized with model's
+    table by triggers. Trigram tokenizer keeps substring semantics of LIKE,
+    which also works with CJK text.
+    '''
+
+    def __init__(self, db, model, pk, columns):
+        '''
+        :param pk: attribute name of integer primary key
+        :param columns: dict of searchable field and column name
+        '''
+        self.db = db
+        self.model = model
+        self.pk = pk
+        self.columns = columns
+        self.pk_column = getattr(model, pk).property.columns[0].name
+        self.content = model.__table__.name
+        self.name = getattr(model, "__msearch_index__",
+                            self.content) + "_msearch"
+        self.table = table(self.name, column("rowid"))
+        self.init()
+
+    def _quote(self, name):
+        return '"{}"'.format(name.replace('"', '""'))
+
+    def init(self):
+        name = self._quote(self.name)
+        content = self._quote(self.content)
+        names = list(self.columns.values())
+        columns = ", ".join(self._quote(c) for c in names)
+        new = ", ".join("new." + self._quote(c) for c in names)
+        old = ", ".join("old." + self._quote(c) for c in names)
+        triggers = {
+            "_ai":
+            "CREATE TRIGGER IF NOT EXISTS {ai} AFTER INSERT ON {content} "
+            "BEGIN "
+            "INSERT INTO {name}(rowid, {columns}) VALUES (new.{pk}, {new}); "
+            "END",
+            "_ad":
+            "CREATE TRIGGER IF NOT EXISTS {ad} AFTER DELETE ON {content} "
+            "BEGIN "
+            "INSERT INTO {name}({name}, rowid, {columns}) "
+            "VALUES ('delete', old.{pk}, {old}); "
+            "END",
+            "_au":
+            "CREATE TRIGGER IF NOT EXISTS {au} AFTER UPDATE ON {content} "
+            "BEGIN "
+            "INSERT INTO {name}({name}, rowid, {columns}) "
+            "VALUES ('delete', old.{pk}, {old}); "
+            "INSERT INTO {name}(rowid, {columns}) VALUES (new.{pk}, {new}); "
+            "END",
+        }
+        kwargs = dict(
+            name=name,
+            content=content,
+            content_name=self.content.replace("'", "''"),
+            pk_name=self.pk_column.replace("'", "''"),
+            columns=columns,
+            pk=self._quote(self.pk_column),
+            new=new,
+            old=old,
+            ai=self._quote(self.name + "_ai"),
+            ad=self._quote(self.name + "_ad"),
+            au=self._quote(self.name + "_au"),
+        )
+        with self.db.engine.begin() as conn:
+            master = dict(
+                conn.execute(
+                    text("SELECT name, sql FROM sqlite_master "
+                         "WHERE name = :name OR tbl_name = :content"),
+                    {
+                        "name": self.name,
+                        "content": self.content
+                    },
+                ).all())
+            sql = master.get(self.name)
+            if sql is None:
+                conn.execute(
+                    text("CREATE VIRTUAL TABLE {name} USING fts5({columns}, "
+                         "content='{content_name}', "
+                         "content_rowid='{pk_name}', "
+                         "tokenize='trigram')".format(**kwargs)))
+            # triggers are dropped with content table, such as batch
+            # migration of alembic which copy, drop and rename table
+            rebuild = sql is None
+            for suffix, trigger in triggers.items():
+                if self.name + suffix not in master:
+                    rebuild = True
+                conn.execute(text(trigger.format(**kwargs)))
+            if rebuild:
+                conn.execute(
+                    text("INSERT INTO {0}({0}) VALUES ('rebuild')".format(
+                        name)))
+
+    def rebuild(self):
+        name = self._quote(self.name)
+        with self.db.engine.begin() as conn:
+            conn.execute(
+                text("INSERT INTO {0}({0}) VALUES ('rebuild')".format(name)))
+
+    def match(self, keywords, fields=None, or_=True):
+        '''
+        such as: {title content}: ("book" OR "movie")
+        '''
+        query = (" OR " if or_ else " AND ").join(
+            '"{}"'.format(keyword.replace('"', '""'))
+            for keyword in keywords)
+        if fields is not None:
+            query = "{%s}: (%s)" % (" ".join(
+                self._quote(self.columns[f]) for f in fields), query)
+        return literal_column(self._quote(self.name)).op("MATCH")(query)
+
+    @property
+    def rank(self):
+        return func.bm25(literal_column(self._quote(self.name)))
+
 
 class SimpleSearch(BaseBackend):
+    database_index = True
+
+    def init_app(self, app):
+        self._setdefault(app)
+        app.config.setdefault("MSEARCH_SIMPLE_FTS", True)
+        self.pk = app.config["MSEARCH_PRIMARY_KEY"]
+        super(SimpleSearch, self).init_app(app)
+
+    def _fts_columns(self, m):
+        '''
+        sqlite FTS5 is only used when primary key is integer and all
+        searchable fields are columns of model's table
+        '''
+        if not self.app.config["MSEARCH_SIMPLE_FTS"]:
+            return
+        if self.db.engine.dialect.name != "sqlite":
+            return
+        pk = getattr(m, "__msearch_primary_key__", self.pk)
+        prop = getattr(getattr(m, pk, None), "property", None)
+        if not isinstance(prop, ColumnProperty) or not isinstance(
+                prop.columns[0].type, types.Integer):
+            return
+        columns = dict()
+        for field in m.__searchable__:
+            prop = getattr(getattr(m, field, None), "property", None)
+            if not isinstance(prop, ColumnProperty):
+                return
+            if prop.columns[0].table is not m.__table__:
+                return
+            columns[field] = prop.columns[0].name
+        return columns
+
+    def index(self, model):
+        '''
+        get sqlite FTS5 index, return None if model or database can't use it
+        '''
+        name = model.__table__.name
+        if name not in self._indexs:
+            index = None
+            columns = self._fts_columns(model)
+            if columns is not None:
+                pk = getattr(model, "__msearch_primary_key__", self.pk)
+                try:
+                    index = Index(self.db, model, pk, columns)
+                except OperationalError as e:
+                    if not UNSUPPORTED_RE.search(str(e.orig)):
+                        # such as table doesn't exist or database is locked,
+                        # use LIKE this time and retry next time
+                        self.logger.warning(
+                            'sqlite FTS5 index error: {}'.format(e.orig))
+                        return
+                    # sqlite is compiled without FTS5 or older than 3.34
+                    self.logger.warning(
+                        'sqlite FTS5 trigram is not supported: {}'.format(
+                            e.orig))
+            self._indexs[name] = index
+        return self._indexs[name]
+
+    def create_index(self, model='__all__', *args, **kwargs):
+        if model == '__all__':
+            return super(SimpleSearch, self).create_index(
+                model, *args, **kwargs)
+        ix = self.index(model)
+        if ix is not None:
+            ix.rebuild()
+        return ix
+
+    def update_index(self, model='__all__', yield_per=100, incremental=False):
+        '''
+        FTS5 table is synchronized by triggers, so incremental is unused
+        '''
+        return self.create_index(model, update=True, yield_per=yield_per)
+
     def msearch(self, m, query, fields=None, limit=None, or_=True):
-        if fields is None:
-            fields = m.__searchable__
-        f = []
         if self.analyzer is not None:
             keywords = self.analyzer(query)
         else:
             keywords = query.split(' ')
+        keywords = [getattr(k, "text", k) for k in keywords]
+        keywords = [k for k in keywords if k]
+
+        ix = None
+        # trigram can't match keyword which is shorter than three characters
+        if keywords and min(len(k) for k in keywords) >= 3:
+            ix = self.index(m)
+        if ix is not None:
+            results = m.query.join(
+                ix.table,
+                ix.table.c.rowid == getattr(m, ix.pk),
+            ).filter(ix.match(keywords, fields, or_)).order_by(ix.rank)
+        else:
+            results = self._like(m, keywords, fields, or_)
+        if limit is not None:
+            results = results.limit(limit)
+        return results
+
+    def _like(self, m, keywords, fields=None, or_=True):
+        if fields is None:
+            fields = m.__searchable__
+        f = []
         for field in fields:
             query = [getattr(m, field).contains(keyword)
                      for keyword in keywords if keyword]
@@ -22,7 +239,4 @@ class SimpleSearch(BaseBackend):
                 f.append(_and(*query))
             else:
                 f.append(_or(*query))
-        results = m.query.filter(_or(*f))
-        if limit is not None:
-            results = results.limit(limit)
-        return results
+        return m.query.filter(_or(*f))
@@ -1,24 +1,64 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import atexit
+import datetime
+import json
+import multiprocessing
 import os
+import random
+import re
+import shutil
 import sys
+import threading
+import time
+from collections import Counter
 
-import sqlalchemy
-from sqlalchemy import types
+from sqlalchemy import func, types
 from whoosh import index as whoosh_index
 from whoosh.analysis import StemmingAnalyzer
 from whoosh.fields import BOOLEAN, DATETIME, ID, NUMERIC, TEXT
 from whoosh.fields import Schema as _Schema
+from whoosh.index import LockError
 from whoosh.qparser import AndGroup, MultifieldParser, OrGroup
+from whoosh.writing import (AsyncWriter, BufferedWriter, MERGE_SMALL,
+                            NO_MERGE, OPTIMIZE)
+from werkzeug.utils import import_string
 
-from .backends import BaseBackend, BaseSchema, relation_column, get_mapper
+from .backends import (BaseBackend, BaseSchema, Hit, Pagination, RankedQuery,
+                       document_builder, get_mapper, hits_query)
 
 DEFAULT_ANALYZER = StemmingAnalyzer()
 
+MERGE_POLICIES = {
+    "small": MERGE_SMALL,
+    "none": NO_MERGE,
+    "optimize": OPTIMIZE,
+}
+
 if sys.version_info[0] < 3:
     str = unicode
 
+# backend and model of parallel create_index, inherited by forked workers
+_parallel_context = None
+
+
+def _parallel_init():
+    backend, model = _parallel_context
+    # don't share database connections with parent process
+    with backend.app.app_context():
+        backend.db.engine.dispose(close=False)
+
+
+def _parallel_documents(pk_range):
+    backend, model = _parallel_context
+    ix = backend.index(model)
+    pk = getattr(model, ix.pk)
+    with backend.app.app_context():
+        instances = backend._index_query(ix).filter(
+            pk >= pk_range[0], pk < pk_range[1])
+        return [backend._document(ix, instance) for instance in instances]
+
 
 class Schema(BaseSchema):
     def __init__(self, index):
@@ -57,10 +97,54 @@ class Schema(BaseSchema):
         return {self.pk: ID(stored=True, unique=True)}
 
 
+def _to_datetime(value):
+    if isinstance(value, datetime.date) and not isinstance(
+            value, datetime.datetime):
+        return datetime.datetime.combine(value, datetime.time())
+    return value
+
+
+def _converter(field):
+    '''
+    keep native value of typed field, whoosh would convert it by itself
+    '''
+    # DATETIME is subclass of NUMERIC
+    if isinstance(field, DATETIME):
+        return _to_datetime
+    if isinstance(field, NUMERIC):
+        return field.numtype
+    if isinstance(field, BOOLEAN):
+        return bool
+    return str
+
+
 class Index(object):
-    def __init__(self, model, name, pk, analyzer, path=""):
+    def __init__(self,
+                 model,
+                 name,
+                 pk,
+                 analyzer,
+                 path="",
+                 merge_options=None,
+                 buffer_options=None,
+                 writer_options=None,
+                 metrics=None):
+        '''
+        :param merge_options: dict of merge_policy, optimize_segments,
+                              optimize_deleted and optimize_interval
+        :param buffer_options: dict of period and limit, when it is set,
+                               changes are buffered by BufferedWriter
+        :param writer_options: dict of timeout, retries, backoff and
+                               async_fallback of acquiring write lock
+        :param metrics: counter of lock wait seconds, retries and timeouts
+        '''
         self.model = model
         self.path = path
+        self.merge_options = merge_options or dict()
+        self.buffer_options = buffer_options
+        self.writer_options = writer_options or dict()
+        self.metrics = Counter() if metrics is None else metrics
+        self._optimized_at = time.time()
         self.name = getattr(
             model,
             "__msearch_index__",
@@ -83,21 +167,200 @@ class Index(object):
                 getattr(model, "__searchable__", []),
             ))
         self._schema = Schema(self)
+        self._document = None
         self._writer = None
+        self._buffered = None
+        self._buffered_dirty = False
+        self._buffered_stopped = None
+        self._searchers = threading.local()
+        self._changed = set()
+        self._realpath = os.path.realpath(self.ix_path)
         self._client = self.init()
 
-    def init(self):
-        ix_path = os.path.join(self.path, self.name)
+    def after_fork(self):
+        '''
+        reopen index in child process, writers and searchers of parent are
+        discarded without closing, because they are still used by parent.
+        '''
+        self._writer = None
+        self._buffered = None
+        self._buffered_dirty = False
+        self._buffered_stopped = None
+        self._searchers = threading.local()
+        self._changed = set()
+        self._realpath = os.path.realpath(self.ix_path)
+        self._client = self.init()
+
+    @property
+    def ix_path(self):
+        return os.path.join(self.path, self.name)
+
+    @property
+    def meta_path(self):
+        return os.path.join(self.ix_path, "msearch.json")
+
+    @property
+    def journal_path(self):
+        return os.path.join(self.path, self.name + ".journal")
+
+    def start_journal(self):
+        '''
+        primary keys of documents changed by all processes are appended to
+        journal until stop_journal
+        '''
+        open(self.journal_path, "w").close()
+
+    def stop_journal(self):
+        if os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+
+    def _journal(self, pks):
+        try:
+            # journal is not created by writers
+            fd = os.open(self.journal_path, os.O_WRONLY | os.O_APPEND)
+        except OSError:
+            return
+        try:
+            # one write of appending mode is not interleaved
+            os.write(fd, "".join(pk + "\n" for pk in pks).encode("utf-8"))
+        finally:
+            os.close(fd)
+
+    def read_journal(self, offset=0):
+        '''
+        read primary keys from offset of journal, return pks and next offset
+        '''
+        if not os.path.exists(self.journal_path):
+            return set(), offset
+        with open(self.journal_path, "rb") as f:
+            f.seek(offset)
+            data = f.read()
+        # the last line may be being written
+        end = data.rfind(b"\n") + 1
+        pks = set(data[:end].decode("utf-8").splitlines())
+        return pks, offset + end
+
+    def get_meta(self, key, default=None):
+        if not os.path.exists(self.meta_path):
+            return default
+        with open(self.meta_path) as f:
+            return json.load(f).get(key, default)
+
+    def set_meta(self, key, value):
+        meta = dict()
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path) as f:
+                meta = json.load(f)
+        meta[key] = value
+        tmp = self.meta_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(meta, f, default=str)
+        os.replace(tmp, self.meta_path)
+
+    def init(self, timeout=5):
+        '''
+        :param timeout: seconds to wait for symlink when directory of index
+                        is being moved to a version by swap
+        '''
+        ix_path = self.ix_path
+        if not os.path.lexists(ix_path) and self.versions():
+            deadline = time.time() + timeout
+            while not os.path.lexists(ix_path):
+                if time.time() > deadline:
+                    raise OSError(
+                        "{} is missing while versions of index exist".format(
+                            ix_path))
+                time.sleep(0.01)
         if whoosh_index.exists_in(ix_path):
             return whoosh_index.open_dir(ix_path)
         if not os.path.exists(ix_path):
             os.makedirs(ix_path)
         return whoosh_index.create_in(ix_path, self.schema)
 
+    def reopen(self):
+        '''
+        reopen index when ix_path has been switched to another directory
+        '''
+        realpath = os.path.realpath(self.ix_path)
+        if realpath == self._realpath:
+            return False
+        self.close()
+        self._writer = None
+        self._realpath = realpath
+        self._client = self.init()
+        return True
+
+    def version_path(self, version):
+        return os.path.join(self.path, "{}.v{}".format(self.name, version))
+
+    def versions(self):
+        '''
+        versions of index directory, sorted from old to new
+        '''
+        pattern = re.compile(r"^{}\.v(\d+)$".format(re.escape(self.name)))
+        versions = []
+        if not os.path.isdir(self.path or "."):
+            return versions
+        for name in os.listdir(self.path or "."):
+            match = pattern.match(name)
+            if match is not None:
+                versions.append(int(match.group(1)))
+        return sorted(versions)
+
+    def create_version(self):
+        '''
+        create a new version of index in sibling directory
+        '''
+        versions = self.versions()
+        path = self.version_path(versions[-1] + 1 if versions else 1)
+        os.makedirs(path)
+        return whoosh_index.create_in(path, self.schema)
+
+    def swap(self, version, keep=2):
+        '''
+        switch symlink of ix_path to the new version atomically, and delete
+        old versions except the latest keep versions.
+        '''
+        path = version.storage.folder
+        if os.path.exists(self.meta_path):
+            shutil.copy(self.meta_path, os.path.join(path, "msearch.json"))
+        if os.path.isdir(self.ix_path) and not os.path.islink(self.ix_path):
+            # directory created before versioning, ix_path is missing until
+            # symlink is created, init waits for it instead of creating
+            os.rename(self.ix_path, self.version_path(0))
+            os.symlink(os.path.basename(self.version_path(0)), self.ix_path)
+        tmp = self.ix_path + ".tmp"
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        os.symlink(os.path.basename(path), tmp)
+        os.replace(tmp, self.ix_path)
+        self.reopen()
+
+        current = os.path.realpath(self.ix_path)
+        for old in self.versions()[:-keep]:
+            old = self.version_path(old)
+            if os.path.realpath(old) != current:
+                shutil.rmtree(old, ignore_errors=True)
+
     @property
     def index(self):
         return self
 
+    @property
+    def document(self):
+        '''
+        compiled document builder of index schema
+        '''
+        if self._document is None:
+            schema = self.schema
+            self._document = document_builder(
+                self.model,
+                self.fields,
+                {name: _converter(schema[name])
+                 for name in self.fields},
+            )
+        return self._document
+
     @property
     def fields(self):
         return self.schema.names()
@@ -106,40 +369,239 @@ class Index(object):
     def schema(self):
         return self._schema.schema
 
-    def create(self, *args, **kwargs):
+    def writer(self, **kwargs):
+        if self.buffer_options and not kwargs:
+            return self.buffered_writer()
+        if self._buffered is not None:
+            # release the write lock held by buffered writer
+            self.close()
         if self._writer is None:
-            self._writer = self._client.writer()
-        return self._writer.add_document(**kwargs)
+            self.reopen()
+            self._writer = self._open_writer(**kwargs)
+        return self._writer
+
+    def _open_writer(self, **kwargs):
+        '''
+        wait write lock for timeout seconds and retry with exponential backoff,
+        fallback to AsyncWriter which commits in a thread when lock is free.
+        '''
+        options = self.writer_options
+        retries = options.get("retries", 0)
+        backoff = options.get("backoff", 0.1)
+        start = time.time()
+        try:
+            for retry in range(retries + 1):
+                try:
+                    return self._client.writer(
+                        timeout=options.get("timeout", 0.0), **kwargs)
+                except LockError:
+                    if retry == retries:
+                        raise
+                    self.metrics["writer_lock_retries"] += 1
+                    # jitter avoids workers retrying at the same time
+                    time.sleep(backoff * 2**retry * random.uniform(1, 2))
+        except LockError:
+            self.metrics["writer_lock_timeouts"] += 1
+            if kwargs or not options.get("async_fallback"):
+                raise
+            self.metrics["writer_async"] += 1
+            return AsyncWriter(self._client)
+        finally:
+            self.metrics["writer_lock_wait"] += time.time() - start
+
+    def buffered_writer(self):
+        '''
+        BufferedWriter is shared between threads and keeps the write lock,
+        buffered changes are committed by a daemon thread every period or
+        when count of buffered documents reaches limit.
+        '''
+        if self._buffered is None:
+            period = self.buffer_options.get("period")
+            # timer of BufferedWriter is not daemon and blocks exit
+            self._buffered = BufferedWriter(
+                self._client,
+                period=None,
+                limit=self.buffer_options.get("limit", 100),
+            )
+            if period:
+                stopped = self._buffered_stopped = threading.Event()
+                thread = threading.Thread(
+                    target=self._buffered_run, args=(stopped, period))
+                thread.daemon = True
+                thread.start()
+            atexit.register(self.close)
+        self._buffered_dirty = True
+        return self._buffered
+
+    def _buffered_run(self, stopped, period):
+        while not stopped.wait(period):
+            self.flush()
+
+    def flush(self):
+        '''
+        commit buffered changes to disk
+        '''
+        buffered = self._buffered
+        if buffered is not None and self._buffered_dirty:
+            self._buffered_dirty = False
+            buffered.commit()
+
+    def close(self):
+        '''
+        commit buffered changes and release the write lock
+        '''
+        buffered, self._buffered = self._buffered, None
+        if self._buffered_stopped is not None:
+            self._buffered_stopped.set()
+            self._buffered_stopped = None
+        if buffered is not None:
+            buffered.close()
+
+    def create(self, *args, **kwargs):
+        self._changed.add(str(kwargs[self.pk]))
+        return self.writer().add_document(**kwargs)
 
     def update(self, *args, **kwargs):
-        if self._writer is None:
-            self._writer = self._client.writer()
-        return self._writer.update_document(**kwargs)
+        self._changed.add(str(kwargs[self.pk]))
+        return self.writer().update_document(**kwargs)
 
     def delete(self, *args, **kwargs):
-        if self._writer is None:
-            self._writer = self._client.writer()
-        return self._writer.delete_by_term(**kwargs)
+        if kwargs.get("fieldname") == self.pk:
+            self._changed.add(str(kwargs["text"]))
+        return self.writer().delete_by_term(**kwargs)
 
     def commit(self):
-        if self._writer is None:
-            self._writer = self._client.writer()
-        r = self._writer.commit()
+        changed, self._changed = self._changed, set()
+        if changed:
+            self._journal(changed)
+        if self._writer is None and self.buffer_options:
+            # changes are committed by buffered writer
+            return
+        policy = self.merge_options.get("merge_policy") or "small"
+        if isinstance(policy, str):
+            policy = MERGE_POLICIES.get(policy) or import_string(policy)
+        r = self.writer().commit(mergetype=policy)
         self._writer = None
+        if self.need_optimize():
+            try:
+                self.optimize()
+            except LockError:
+                # documents have been committed, optimize on later commit
+                self.metrics["optimize_lock_errors"] += 1
         return r
 
+    def need_optimize(self):
+        '''
+        optimize when segment count or deleted ratio passes the threshold,
+        or the interval since last optimize has passed
+        '''
+        options = self.merge_options
+        interval = options.get("optimize_interval")
+        if interval and time.time() - self._optimized_at >= interval:
+            return True
+        segments = options.get("optimize_segments")
+        deleted = options.get("optimize_deleted")
+        if not segments and not deleted:
+            return False
+        stats = self.stats
+        if segments and stats["segment_count"] > segments:
+            return True
+        return bool(deleted and stats["deleted_ratio"] > deleted)
+
+    def optimize(self):
+        '''
+        merge all segments into one and purge deleted documents
+        '''
+        self._open_writer().commit(optimize=True)
+        self._optimized_at = time.time()
+
+    @property
+    def stats(self):
+        segments = self._client._segments()
+        doc_count_all = sum(s.doc_count_all() for s in segments)
+        doc_count = sum(s.doc_count() for s in segments)
+        size = 0
+        for name in os.listdir(self.ix_path):
+            size += os.path.getsize(os.path.join(self.ix_path, name))
+        return {
+            "doc_count": doc_count,
+            "segment_count": len(segments),
+            "deleted_ratio": (float(doc_count_all - doc_count) / doc_count_all
+                              if doc_count_all else 0.0),
+            "size": size,
+            "last_commit": self._client.last_modified(),
+        }
+
+    @property
+    def searcher(self):
+        '''
+        keep one searcher per thread, and only reopen the changed segments
+        when the index generation has been bumped by a commit.
+        '''
+        self.reopen()
+        if self._buffered is not None:
+            # include buffered documents which are not committed
+            return self._buffered.searcher()
+        searcher = getattr(self._searchers, "searcher", None)
+        if searcher is None or self._searchers.path != self._realpath:
+            searcher = self._client.searcher()
+        else:
+            searcher = searcher.refresh()
+        self._searchers.searcher = searcher
+        self._searchers.path = self._realpath
+        return searcher
+
     def search(self, *args, **kwargs):
-        return self._client.searcher().search(*args, **kwargs)
+        return self.searcher.search(*args, **kwargs)
+
+    def search_page(self, *args, **kwargs):
+        return self.searcher.search_page(*args, **kwargs)
+
+    @property
+    def generation(self):
+        # generation of a rebuilt index starts from zero again
+        self.reopen()
+        return (self._realpath, self._client.latest_generation())
 
 
 class WhooshSearch(BaseBackend):
     def init_app(self, app):
         self._setdefault(app)
         self._signal_connect(app)
+        app.config.setdefault("MSEARCH_INDEX_PROCS", 1)
+        app.config.setdefault("MSEARCH_MERGE_POLICY", "small")
+        app.config.setdefault("MSEARCH_OPTIMIZE_SEGMENTS", 0)
+        app.config.setdefault("MSEARCH_OPTIMIZE_DELETED", 0)
+        app.config.setdefault("MSEARCH_OPTIMIZE_INTERVAL", 0)
+        app.config.setdefault("MSEARCH_BUFFERED_WRITER", False)
+        app.config.setdefault("MSEARCH_BUFFERED_PERIOD", 60)
+        app.config.setdefault("MSEARCH_BUFFERED_LIMIT", 100)
+        app.config.setdefault("MSEARCH_WRITER_TIMEOUT", 1.0)
+        app.config.setdefault("MSEARCH_WRITER_RETRIES", 2)
+        app.config.setdefault("MSEARCH_WRITER_BACKOFF", 0.2)
+        app.config.setdefault("MSEARCH_WRITER_ASYNC", False)
         if self.analyzer is None:
             self.analyzer = app.config["MSEARCH_ANALYZER"] or DEFAULT_ANALYZER
         self.pk = app.config["MSEARCH_PRIMARY_KEY"]
         self.index_name = app.config["MSEARCH_INDEX_NAME"]
+        self.merge_options = {
+            "merge_policy": app.config["MSEARCH_MERGE_POLICY"],
+            "optimize_segments": app.config["MSEARCH_OPTIMIZE_SEGMENTS"],
+            "optimize_deleted": app.config["MSEARCH_OPTIMIZE_DELETED"],
+            "optimize_interval": app.config["MSEARCH_OPTIMIZE_INTERVAL"],
+        }
+        self.writer_options = {
+            "timeout": app.config["MSEARCH_WRITER_TIMEOUT"],
+            "retries": app.config["MSEARCH_WRITER_RETRIES"],
+            "backoff": app.config["MSEARCH_WRITER_BACKOFF"],
+            "async_fallback": app.config["MSEARCH_WRITER_ASYNC"],
+        }
+        self.buffer_options = None
+        if app.config["MSEARCH_BUFFERED_WRITER"]:
+            self.buffer_options = {
+                "period": app.config["MSEARCH_BUFFERED_PERIOD"],
+                "limit": app.config["MSEARCH_BUFFERED_LIMIT"],
+            }
         super(WhooshSearch, self).init_app(app)
 
     def index(self, model):
@@ -154,9 +616,20 @@ class WhooshSearch(BaseBackend):
                 self.pk,
                 self.analyzer,
                 self.index_name,
+                self.merge_options,
+                self.buffer_options,
+                self.writer_options,
+                self.metrics,
             )
         return self._indexs[name]
 
+    def stats(self, model):
+        '''
+        doc count, segment count, deleted ratio, size on disk and last commit
+        time of model's index
+        '''
+        return self.index(model).stats
+
     def create_one_index(self,
                          instance,
                          update=False,
@@ -174,33 +647,160 @@ class WhooshSearch(BaseBackend):
             raise ValueError("update and delete can't work togther")
         ix = self.index(instance.__class__)
         pk = ix.pk
-        attrs = {pk: str(getattr(instance, pk))}
-
-        for field in ix.fields:
-            if '.' in field:
-                attrs[field] = str(relation_column(instance, field.split('.')))
-            else:
-                attrs[field] = str(getattr(instance, field))
         if delete:
             self.logger.debug('deleting index: {}'.format(instance))
             ix.delete(fieldname=pk, text=str(getattr(instance, pk)))
         elif update:
             self.logger.debug('updating index: {}'.format(instance))
-            ix.update(**attrs)
+            ix.update(**self._document(ix, instance))
         else:
             self.logger.debug('creating index: {}'.format(instance))
-            ix.create(**attrs)
+            ix.create(**self._document(ix, instance))
         if commit:
             ix.commit()
         return instance
 
+    def _document(self, index, instance):
+        return index.document(instance)
+
     def _fields(self, index, attr):
         return attr
 
-    def msearch(self, m, query, fields=None, limit=None, or_=True, **kwargs):
+    def _rebuild_index(self, index, yield_per=100):
         '''
-        set limit make search faster
+        index all rows into a new directory, then switch symlink to it,
+        documents changed by other processes meanwhile are replayed.
+        '''
+        version = index.create_version()
+        # writers see journal before rows are read
+        index.start_journal()
+        try:
+            writer = version.writer()
+            try:
+                for instance in self._index_query(index).yield_per(yield_per):
+                    writer.add_document(**index.document(instance))
+            except Exception:
+                writer.cancel()
+                raise
+            writer.commit()
+            offset = self._replay(index, version.writer)
+        except Exception:
+            index.stop_journal()
+            shutil.rmtree(version.storage.folder, ignore_errors=True)
+            raise
+        index.swap(version, self.app.config["MSEARCH_KEEP_VERSIONS"])
+        # changes committed to old directory before writers reopen index,
+        # write lock of version is shared with writers now
+        self._replay(index, index._open_writer, offset)
+        index.stop_journal()
+        return index
+
+    def _replay(self, index, open_writer, offset=0):
+        '''
+        reindex documents of journal from offset until no more changes
+        '''
+        while True:
+            pks, offset = index.read_journal(offset)
+            if not pks:
+                return offset
+            writer = open_writer()
+            for instance in self._instances(index, pks):
+                document = index.document(instance)
+                pks.discard(document[index.pk])
+                writer.update_document(**document)
+            for pk in pks:
+                writer.delete_by_term(index.pk, pk)
+            writer.commit()
+
+    def _index_pks(self, index, batch_size=500):
+        '''
+        terms of primary key field are sorted, deleted documents which are
+        not merged yet would be skipped
+        '''
+        with index._client.reader() as reader:
+            deleted = reader.has_deletions()
+            for term in reader.lexicon(index.pk):
+                pk = term.decode("utf-8")
+                if deleted and not reader.postings(index.pk, pk).is_active():
+                    continue
+                yield pk
+
+    def _delete_pks(self, index, pks):
+        for pk in pks:
+            index.delete(fieldname=index.pk, text=pk)
+
+    def create_index(self,
+                     model='__all__',
+                     update=False,
+                     delete=False,
+                     yield_per=100,
+                     chunk_size=None,
+                     resume=False,
+                     rebuild=False,
+                     procs=None):
         '''
+        :param procs: when procs is greater than 1, documents are loaded by
+                      a process pool over primary key ranges and analyzed by
+                      whoosh multiprocessing writer, default `MSEARCH_INDEX_PROCS`
+        '''
+        if procs is None:
+            procs = self.app.config["MSEARCH_INDEX_PROCS"]
+        if (model == '__all__' or update or delete or chunk_size or rebuild
+                or procs <= 1):
+            return super(WhooshSearch, self).create_index(
+                model, update, delete, yield_per, chunk_size, resume, rebuild)
+
+        ix = self.index(model)
+        pk = getattr(model, ix.pk)
+        if not issubclass(pk.type.python_type, int):
+            self.logger.warning(
+                'parallel index needs integer primary key: {}'.format(ix.name))
+            return super(WhooshSearch, self).create_index(
+                model, update, delete, yield_per)
+        return self._parallel_create_index(ix, model, procs, yield_per)
+
+    def _parallel_create_index(self, ix, model, procs, yield_per):
+        global _parallel_context
+
+        start = time.time()
+        pk = getattr(model, ix.pk)
+        low, high = self.db.session.query(func.min(pk), func.max(pk)).one()
+        if low is None:
+            return ix
+
+        step = yield_per * 10
+        ranges = [(i, i + step) for i in range(low, high + 1, step)]
+
+        count = 0
+        writer = ix.writer(procs=procs, multisegment=True)
+        _parallel_context = (self, model)
+        try:
+            pool = multiprocessing.get_context("fork").Pool(
+                procs, initializer=_parallel_init)
+            try:
+                for documents in pool.imap_unordered(
+                        _parallel_documents, ranges):
+                    for document in documents:
+                        writer.add_document(**document)
+                    count += len(documents)
+            finally:
+                pool.close()
+                pool.join()
+            ix.commit()
+        except Exception:
+            writer.cancel()
+            ix._writer = None
+            raise
+        finally:
+            _parallel_context = None
+
+        seconds = time.time() - start
+        self.logger.info(
+            'parallel index {}: {} documents in {:.2f}s, {:.1f} docs/sec'.
+            format(ix.name, count, seconds, count / seconds if seconds else 0))
+        return ix
+
+    def _parse(self, m, query, fields=None, or_=True, **kwargs):
         ix = self.index(m)
         if fields is None:
             fields = ix.fields
@@ -215,12 +815,43 @@ class WhooshSearch(BaseBackend):
             group,
             **kwargs,
         )
-        return ix.search(parser.parse(query), limit=limit)
+        return parser.parse(query)
+
+    def msearch(self, m, query, fields=None, limit=None, or_=True, **kwargs):
+        '''
+        set limit make search faster
+        '''
+        ix = self.index(m)
+        return ix.search(
+            self._parse(m, query, fields, or_, **kwargs), limit=limit)
+
+    def _hits(self,
+              m,
+              query,
+              fields=None,
+              limit=None,
+              or_=True,
+              page=None,
+              per_page=20,
+              **kwargs):
+        ix = self.index(m)
+        if page is None:
+            results = self.msearch(m, query, fields, limit, or_, **kwargs)
+        else:
+            results = ix.search_page(
+                self._parse(m, query, fields, or_, **kwargs), page, per_page)
+            if results.pagenum != page:
+                # whoosh returns the last page when page is past the end
+                return results.total, []
+        hits = [Hit(r[ix.pk], r.rank, r.score, r.fields()) for r in results]
+        if page is None:
+            return len(hits), hits
+        return results.total, hits
 
     def _query_class(self, q):
         _self = self
 
-        class Query(q):
+        class Query(RankedQuery, q):
             def whoosh_search(self, query, fields=None, limit=None, or_=False):
                 self.logger.warning(
                     'whoosh_search has been replaced by msearch.please use msearch'
@@ -234,30 +865,40 @@ class WhooshSearch(BaseBackend):
                     limit=None,
                     or_=False,
                     rank_order=False,
+                    page=None,
+                    per_page=20,
                     **kwargs):
+                '''
+                when page is not None, only hits of the page would be queried
+                from database, and return pagination instead of query.
+                '''
                 model = get_mapper(self).class_
                 ix = _self.index(model)
-                results = _self.msearch(
+                total, results = _self._search_hits(
                     model,
                     query,
                     fields,
                     limit,
                     or_,
+                    page,
+                    per_page,
                     **kwargs,
                 )
-                if not results:
-                    return self.filter(False)
-                result_set = set()
-                for i in results:
-                    result_set.add(i[ix.pk])
-                result_query = self.filter(
-                    getattr(model, ix.pk).in_(result_set))
-                if rank_order:
-                    result_query = result_query.order_by(
-                        sqlalchemy.sql.expression.case(
-                            {r[ix.pk]: r.rank
-                             for r in results},
-                            value=getattr(model, ix.pk)))
-                return result_query
+                result_query = hits_query(
+                    self,
+                    getattr(model, ix.pk),
+                    results,
+                    rank_order,
+                    _self.app.config["MSEARCH_RANK_CASE_LIMIT"],
+                )
+                if page is None:
+                    return result_query
+                return Pagination(
+                    result_query,
+                    page,
+                    per_page,
+                    total,
+                    result_query.all() if results else [],
+                )
 
         return Query
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from test import (TestMixin, SearchTestBase, mkdtemp, Flask, SQLAlchemy,
+                  Search, unittest, ModelSaveMixin)
+
+
+class TestSearch(TestMixin, SearchTestBase):
+    def setUp(self):
+        class TestConfig(object):
+            SQLALCHEMY_TRACK_MODIFICATIONS = True
+            SQLALCHEMY_DATABASE_URI = 'sqlite://'
+            DEBUG = True
+            TESTING = True
+            MSEARCH_INDEX_NAME = mkdtemp()
+            MSEARCH_BACKEND = 'database'
+
+        self.app = Flask(__name__)
+        self.app.config.from_object(TestConfig())
+        self.db = SQLAlchemy(self.app)
+        self.search = Search(self.app, db=self.db)
+
+        db = self.db
+
+        class Post(db.Model, ModelSaveMixin):
+            __tablename__ = 'basic_posts'
+            __searchable__ = ['title', 'content']
+
+            id = db.Column(db.Integer, primary_key=True)
+            title = db.Column(db.String(49))
+            content = db.Column(db.Text)
+
+            def __repr__(self):
+                return '<Post:{}>'.format(self.title)
+
+        self.Post = Post
+        self.init_data()
+
+    def test_postings(self):
+        with self.app.test_request_context():
+            postings = self.search.postings
+            rows = self.db.session.execute(
+                postings.select().where(postings.c.token == 'book')).all()
+            self.assertEqual(len(rows), 3)
+            self.assertEqual(set(r.field for r in rows), {'title'})
+
+            self.search.create_index(self.Post, update=True)
+            rows = self.db.session.execute(
+                postings.select().where(postings.c.token == 'book')).all()
+            self.assertEqual(len(rows), 3)
+
+            self.search.create_index(self.Post)
+            rows = self.db.session.execute(
+                postings.select().where(postings.c.token == 'book')).all()
+            self.assertEqual(len(rows), 3)
+
+            plan = self.db.session.execute(
+                self.db.text("EXPLAIN QUERY PLAN DELETE FROM msearch_postings "
+                             "WHERE \"index\" = 'x' AND pk IN ('1', '2')")
+            ).all()
+            self.assertIn('msearch_postings_pk', str(plan))
+
+            self.search.create_index(self.Post, delete=True)
+            results = self.Post.query.msearch('book').all()
+            self.assertEqual(len(results), 0)
+
+    def test_analyzer(self):
+        from whoosh.analysis import StemmingAnalyzer
+
+        app = Flask(__name__)
+        app.config.update(
+            SQLALCHEMY_TRACK_MODIFICATIONS=True,
+            SQLALCHEMY_DATABASE_URI='sqlite://',
+            MSEARCH_BACKEND='database',
+            MSEARCH_ANALYZER=StemmingAnalyzer(),
+            MSEARCH_POSTINGS_TABLE='analyzer_postings',
+        )
+        db = SQLAlchemy(app)
+
+        class Post(db.Model):
+            __tablename__ = 'analyzer_posts'
+            __searchable__ = ['title']
+
+            id = db.Column(db.Integer, primary_key=True)
+            title = db.Column(db.String(49))
+
+        Search(app, db=db)
+        with app.test_request_context():
+            db.create_all()
+            db.session.add(Post(title='reading books'))
+            db.session.commit()
+            self.assertEqual(len(Post.query.msearch('book').all()), 1)
+            db.drop_all()
+
+    def test_reconcile(self):
+        with self.app.test_request_context():
+            ix = self.search.index(self.Post)
+            ix.delete(id=2)
+            ix.create(id=100, title='orphan book', content='content')
+            ix.commit()
+
+            result = self.search.reconcile(self.Post)
+            self.assertEqual(result, {"missing": 1, "orphan": 1})
+            results = self.Post.query.msearch('book').all()
+            self.assertEqual(len(results), 3)
+            self.assertEqual(next(self.search._index_pks(ix)), '1')
+
+    def test_hits(self):
+        with self.app.test_request_context():
+            with self.assertRaises(NotImplementedError):
+                self.search.msearch_hits(self.Post, 'book')
+
+            self.app.config["MSEARCH_CACHE"] = True
+            self.search.init_app(self.app)
+            with self.assertRaises(NotImplementedError):
+                self.search.msearch_hits(self.Post, 'book')
+
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromNames(
+        ['test_database.TestSearch', ])
+    unittest.TextTestRunner(verbosity=1).run(suite)
@@ -88,6 +88,86 @@ class TestSearch(TestMixin, SearchTestBase):
             results = self.Post.query.msearch('abc').all()
             self.assertEqual(len(results), 0)
 
+    def test_bulk_index(self):
+        with self.app.test_request_context():
+            self.search.delete_index(self.Post)
+            results = self.Post.query.msearch('book').all()
+            self.assertEqual(len(results), 0)
+
+            self.search.create_index(self.Post)
+            results = self.Post.query.msearch('book').all()
+            self.assertEqual(len(results), 3)
+
+    def test_update_upsert(self):
+        with self.app.test_request_context():
+            self.search.delete_index(self.Post)
+            # documents which aren't indexed yet are created by update
+            self.search.update_index(self.Post)
+            results = self.Post.query.msearch('book').all()
+            self.assertEqual(len(results), 3)
+
+    def test_mapping(self):
+        with self.app.test_request_context():
+            ix = self.search.index(self.Post)
+            # keys of response are concrete index behind alias
+            mapping = self.search.indices.get_mapping(index=ix.name)
+            mapping = list(mapping.values())[0]
+            properties = mapping["mappings"][ix.doc_type]["properties"]
+            self.assertEqual(properties["title"], {"type": "text"})
+
+            self.search.create_index(self.Post, update=True)
+            settings = self.search.indices.get_settings(index=ix.name)
+            settings = list(settings.values())[0]["settings"]["index"]
+            self.assertNotEqual(settings.get("refresh_interval"), "-1")
+
+    def test_rebuild(self):
+        with self.app.test_request_context():
+            ix = self.search.index(self.Post)
+            ix.set_meta("watermark", "2020-01-01T00:00:00")
+            versions = ix.versions()
+            self.search.create_index(self.Post, rebuild=True)
+            self.assertEqual(ix.get_meta("watermark"), "2020-01-01T00:00:00")
+            self.assertEqual(ix.versions()[-1], versions[-1] + 1)
+            aliases = self.search.indices.get_alias(name=ix.name)
+            self.assertEqual(
+                list(aliases), [ix.version_name(versions[-1] + 1)])
+
+            results = self.Post.query.msearch('book').all()
+            self.assertEqual(len(results), 3)
+
+            self.search.create_index(self.Post, rebuild=True)
+            self.search.create_index(self.Post, rebuild=True)
+            self.assertEqual(len(ix.versions()), 2)
+
+    def test_rebuild_concurrent_writes(self):
+        with self.app.test_request_context():
+            ix = self.search.index(self.Post)
+            document = ix.document
+            written = []
+
+            def write(instance):
+                # rows are changed by another process after being read
+                if not written:
+                    written.append(instance.id)
+                    session = self.db.session.session_factory()
+                    session.get(self.Post, 1).title = 'rebuilt book'
+                    session.delete(session.get(self.Post, 2))
+                    session.add(self.Post(title='inserted book', content=''))
+                    session.commit()
+                    session.close()
+                return document(instance)
+
+            ix._document = write
+            self.search.create_index(self.Post, rebuild=True)
+            ix._document = document
+            self.assertEqual(written, [1])
+            self.assertFalse(
+                self.search.indices.exists(index=ix.journal_name))
+
+            hits = self.search.msearch_hits(self.Post, 'book')
+            self.assertEqual(
+                set(hit.pk for hit in hits), {'1', '3', '5', '6'})
+
 
 if __name__ == '__main__':
     suite = unittest.TestLoader().loadTestsFromNames(
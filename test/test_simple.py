@@ -3,6 +3,11 @@
 from test import (TestMixin, SearchTestBase, mkdtemp, Flask, SQLAlchemy,
                   Search, unittest, ModelSaveMixin)
 
+import sqlite3
+from unittest import mock
+
+from sqlalchemy.exc import OperationalError
+
 
 class TestSearch(TestMixin, SearchTestBase):
     def setUp(self):
@@ -35,6 +40,109 @@ class TestSearch(TestMixin, SearchTestBase):
         self.Post = Post
         self.init_data()
 
+    def test_fts(self):
+        with self.app.test_request_context():
+            self.assertIsNotNone(self.search.index(self.Post))
+            query = self.Post.query.msearch('book')
+            self.assertIn('MATCH', str(query))
+
+            results = self.Post.query.msearch('ook').all()
+            self.assertEqual(len(results), 3)
+
+            post1 = self.Post(title='我爱中文搜索', content='user@example.com')
+            post1.save(self.db)
+            post2 = self.Post(title='C++ primer', content='')
+            post2.save(self.db)
+            results = self.Post.query.msearch('中文').all()
+            self.assertEqual([r.id for r in results], [post1.id])
+            results = self.Post.query.msearch('中文搜').all()
+            self.assertEqual([r.id for r in results], [post1.id])
+            results = self.Post.query.msearch('C++').all()
+            self.assertEqual([r.id for r in results], [post2.id])
+
+            post1.title = '我爱英文'
+            post1.save(self.db)
+            self.assertEqual(self.Post.query.msearch('中文搜').all(), [])
+            self.assertEqual(len(self.Post.query.msearch('英文').all()), 1)
+            post2.delete(self.db)
+            self.assertEqual(self.Post.query.msearch('primer').all(), [])
+
+            self.app.config["MSEARCH_SIMPLE_FTS"] = False
+            self.search._indexs.clear()
+            query = self.Post.query.msearch('book')
+            self.assertNotIn('MATCH', str(query))
+            self.assertEqual(len(query.all()), 3)
+
+    def test_fts_errors(self):
+        with self.app.test_request_context():
+            for message, cached in [("database is locked", False),
+                                    ("no such module: fts5", True)]:
+                self.search._indexs.clear()
+                error = OperationalError(
+                    None, None, sqlite3.OperationalError(message))
+                with mock.patch("flask_msearch.simple_backend.Index",
+                                side_effect=error):
+                    self.assertIsNone(self.search.index(self.Post))
+                self.assertEqual(
+                    self.Post.__tablename__ in self.search._indexs, cached)
+                results = self.Post.query.msearch('book').all()
+                self.assertEqual(len(results), 3)
+
+    def test_warmup(self):
+        # tables don't exist when init_app
+        app = Flask(__name__)
+        app.config.update(
+            SQLALCHEMY_DATABASE_URI='sqlite://',
+            MSEARCH_BACKEND='simple',
+            MSEARCH_WARMUP=True,
+        )
+        db = SQLAlchemy(app)
+
+        class Post(db.Model):
+            __tablename__ = 'warmup_posts'
+            __searchable__ = ['title']
+
+            id = db.Column(db.Integer, primary_key=True)
+            title = db.Column(db.String(49))
+
+        search = Search(app, db=db)
+        self.assertEqual(search._indexs, {})
+        with app.test_request_context():
+            db.create_all()
+            self.assertIsNotNone(search.index(Post))
+            db.drop_all()
+
+    def test_fts_triggers(self):
+        with self.app.test_request_context():
+            self.search.index(self.Post)
+            # such as batch migration of alembic
+            for sql in [
+                    "CREATE TABLE _tmp AS SELECT * FROM basic_posts",
+                    "DROP TABLE basic_posts",
+                    "ALTER TABLE _tmp RENAME TO basic_posts",
+            ]:
+                self.db.session.execute(self.db.text(sql))
+            self.db.session.commit()
+            self.search._indexs.clear()
+            self.search.index(self.Post)
+
+            self.db.session.execute(
+                self.db.text("INSERT INTO basic_posts (id, title, content) "
+                             "VALUES (6, 'another book', '')"))
+            self.db.session.commit()
+            results = self.Post.query.msearch('book').all()
+            self.assertEqual(len(results), 4)
+
+    def test_hits(self):
+        with self.app.test_request_context():
+            with self.assertRaises(NotImplementedError):
+                self.search.msearch_hits(self.Post, 'book')
+
+            self.app.config["MSEARCH_CACHE"] = True
+            self.search.init_app(self.app)
+            with self.assertRaises(NotImplementedError):
+                self.search.msearch_hits(self.Post, 'book')
+
 
 if __name__ == '__main__':
     suite = unittest.TestLoader().loadTestsFromNames(
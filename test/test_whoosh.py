@@ -2,10 +2,22 @@
 # -*- coding: utf-8 -*-
 from test import (
     TestMixin, SearchTestBase, mkdtemp, Flask, SQLAlchemy, Search, unittest,
-    ModelSaveMixin, hybrid_property, datetime)
-
+    ModelSaveMixin, hybrid_property, datetime, os, titles)
+
+import threading
+import time
+from unittest import mock
+
+from flask_msearch.backends import Hit, document_builder, hits_query
+from flask_msearch.cache import SearchCache
+from flask_msearch.signal import IndexQueue, queue_signal
+from flask_msearch.whoosh_backend import Index
+from sqlalchemy import event
+from sqlalchemy.dialects import mysql
 from whoosh.analysis import RegexTokenizer, Filter
 from whoosh.fields import TEXT
+from whoosh.index import LockError
+from whoosh.writing import AsyncWriter
 
 
 class CaseSensitivizer(Filter):
@@ -60,6 +72,516 @@ class TestSearch(TestMixin, SearchTestBase):
             results = self.Post.query.msearch('abc').all()
             self.assertEqual(len(results), 0)
 
+    def test_batch_commit(self):
+        with self.app.test_request_context():
+            ix = self.search.index(self.Post)
+            generation = ix._client.latest_generation()
+            for i in range(10):
+                self.db.session.add(
+                    self.Post(title="batch %d" % i, content="batch"))
+            self.db.session.commit()
+            self.assertEqual(ix._client.latest_generation(), generation + 1)
+
+            results = self.Post.query.msearch('batch').all()
+            self.assertEqual(len(results), 10)
+
+    def test_searcher_reuse(self):
+        with self.app.test_request_context():
+            ix = self.search.index(self.Post)
+            searcher = ix.searcher
+            self.Post.query.msearch('book').all()
+            self.assertIs(ix.searcher, searcher)
+
+            self.Post(title="new book", content="content").save(self.db)
+            self.assertIsNot(ix.searcher, searcher)
+            results = self.Post.query.msearch('book').all()
+            self.assertEqual(len(results), 4)
+
+    def test_chunked_index(self):
+        with self.app.test_request_context():
+            ix = self.search.delete_index(self.Post)
+            results = self.Post.query.msearch('book').all()
+            self.assertEqual(len(results), 0)
+
+            # resume from the checkpoint of an interrupted rebuild
+            ix.set_meta("checkpoint", 2)
+            self.search.create_index(self.Post, chunk_size=2, resume=True)
+            self.assertIsNone(ix.get_meta("checkpoint"))
+            results = self.Post.query.msearch('book').all()
+            self.assertEqual([i.title for i in results], [titles[2], titles[4]])
+
+            self.search.create_index(self.Post, update=True, chunk_size=2)
+            results = self.Post.query.msearch('book').all()
+            self.assertEqual(len(results), 3)
+
+            # pending changes of session are not discarded
+            self.db.session.add(self.Post(title='pending', content=''))
+            self.search.create_index(self.Post, chunk_size=2)
+            self.db.session.commit()
+            self.assertEqual(self.Post.query.count(), 6)
+
+    def test_optimize(self):
+        with self.app.test_request_context():
+            for i in range(3):
+                self.Post(title='new book', content='content').save(self.db)
+            stats = self.search.stats(self.Post)
+            self.assertEqual(stats["doc_count"], 8)
+            self.assertGreater(stats["segment_count"], 1)
+            self.assertGreater(stats["size"], 0)
+
+            ix = self.search.index(self.Post)
+            ix.merge_options["optimize_segments"] = 1
+            self.Post(title='new book', content='content').save(self.db)
+            stats = self.search.stats(self.Post)
+            self.assertEqual(stats["segment_count"], 1)
+            self.assertEqual(stats["deleted_ratio"], 0)
+            results = self.Post.query.msearch('book').all()
+            self.assertEqual(len(results), 7)
+
+            # lock is held by another worker when optimizing
+            ix.writer()
+            ix.create(id='100', title='locked book', content='content')
+            ix.create(id='101', title='locked book', content='content')
+            with mock.patch.object(ix, "_open_writer", side_effect=LockError):
+                ix.commit()
+            self.assertEqual(self.search.metrics["optimize_lock_errors"], 1)
+            self.assertEqual(self.search.stats(self.Post)["doc_count"], 11)
+            self.Post(title='new book', content='content').save(self.db)
+            self.assertEqual(self.search.stats(self.Post)["segment_count"], 1)
+
+    def test_buffered_writer(self):
+        with self.app.test_request_context():
+            ix = self.search.index(self.Post)
+            ix.buffer_options = {"period": None, "limit": 100}
+            self.Post(title='new book', content='content').save(self.db)
+            post = self.Post.query.filter_by(title=titles[0]).one()
+            post.title = 'watch a book'
+            post.save(self.db)
+
+            # buffered documents can be searched before committed to disk
+            self.assertEqual(self.search.stats(self.Post)["doc_count"], 5)
+            results = self.Post.query.msearch('book').all()
+            self.assertEqual(len(results), 5)
+
+            ix.flush()
+            self.assertEqual(self.search.stats(self.Post)["doc_count"], 6)
+            ix.close()
+            results = self.Post.query.msearch('book').all()
+            self.assertEqual(len(results), 5)
+
+    def test_writer_lock(self):
+        with self.app.test_request_context():
+            ix = self.search.index(self.Post)
+            ix.writer_options = {"timeout": 0, "retries": 1, "backoff": 0.01}
+            lock = ix._client.writer()
+            try:
+                with self.assertRaises(LockError):
+                    ix.writer()
+                metrics = self.search.metrics
+                self.assertEqual(metrics["writer_lock_retries"], 1)
+                self.assertEqual(metrics["writer_lock_timeouts"], 1)
+                self.assertGreater(metrics["writer_lock_wait"], 0)
+
+                ix.writer_options["async_fallback"] = True
+                self.assertIsInstance(ix.writer(), AsyncWriter)
+                ix.create(id='100', title='async book', content='content')
+                ix.commit()
+            finally:
+                lock.cancel()
+            # AsyncWriter commits in a thread after lock is released
+            for _ in range(50):
+                hits = self.search.msearch_hits(self.Post, 'book')
+                if '100' in set(hit.pk for hit in hits):
+                    break
+                time.sleep(0.1)
+            self.assertIn('100', set(hit.pk for hit in hits))
+
+    def test_insert_then_update(self):
+        with self.app.test_request_context():
+            backend = self.search._backend
+            with mock.patch.object(
+                    backend, "create_one_index",
+                    wraps=backend.create_one_index) as create_one_index:
+                post = self.Post(title='flushed book', content='content')
+                self.db.session.add(post)
+                self.db.session.flush()
+                post.title = 'modified book'
+                self.db.session.commit()
+            # document doesn't exist in index, so it isn't updated
+            self.assertEqual(create_one_index.call_count, 1)
+            self.assertFalse(create_one_index.call_args[1].get("update"))
+            results = self.Post.query.msearch('modified').all()
+            self.assertEqual([r.id for r in results], [post.id])
+
+    def test_skip_unchanged(self):
+        with self.app.test_request_context():
+            ix = self.search.index(self.Post)
+            generation = ix.generation
+            post = self.Post.query.filter_by(title=titles[1]).one()
+            post.title = titles[1]
+            post.save(self.db)
+            self.assertEqual(self.search.metrics["update_skipped"], 1)
+            self.assertEqual(ix.generation, generation)
+
+            post.title = 'read a novel'
+            post.save(self.db)
+            self.assertEqual(self.search.metrics["update_indexed"], 1)
+            results = self.Post.query.msearch('book').all()
+            self.assertEqual(len(results), 2)
+
+    def test_warmup(self):
+        with self.app.test_request_context():
+            self.search._indexs.clear()
+            indexs = self.search.warmup()
+            self.assertIn(self.Post.__table__.name, self.search._indexs)
+            self.assertEqual(len(indexs), len(self.search._indexs))
+
+            ix = self.search.index(self.Post)
+            searcher = ix.searcher
+            self.search.after_fork()
+            self.assertIsNot(ix.searcher, searcher)
+            results = self.Post.query.msearch('book').all()
+            self.assertEqual(len(results), 3)
+
+            searcher = ix.searcher
+            pid = os.fork()
+            if pid == 0:
+                # child process reopens index after fork
+                os._exit(0 if ix.searcher is not searcher else 1)
+            self.assertEqual(os.waitpid(pid, 0)[1], 0)
+
+    def test_missing_root(self):
+        with self.app.test_request_context():
+            ix = self.search.index(self.Post)
+            path = os.path.join(mkdtemp(), 'msearch')
+            other = Index(self.Post, ix.name, ix.pk, ix.analyzer, path)
+            self.assertTrue(os.path.isdir(other.ix_path))
+            self.assertEqual(other.versions(), [])
+
+    def test_rebuild(self):
+        with self.app.test_request_context():
+            ix = self.search.index(self.Post)
+            # index of the same directory in another process
+            other = Index(self.Post, ix.name, ix.pk, ix.analyzer, ix.path)
+            self.assertEqual(other.searcher.doc_count(), 5)
+
+            ix.create(id='100', title='stale book', content='content')
+            ix.commit()
+            self.assertEqual(other.searcher.doc_count(), 6)
+            self.search.create_index(self.Post, rebuild=True)
+            self.assertTrue(os.path.islink(ix.ix_path))
+            self.assertEqual(ix.versions(), [0, 1])
+
+            hits = self.search.msearch_hits(self.Post, 'book')
+            self.assertEqual(set(hit.pk for hit in hits), {'2', '3', '5'})
+            self.assertEqual(other.searcher.doc_count(), 5)
+
+            # ix_path is missing while swap moves it, init must not create it
+            target = os.readlink(ix.ix_path)
+            os.remove(ix.ix_path)
+            with self.assertRaises(OSError):
+                other.init(timeout=0)
+            timer = threading.Timer(0.1, os.symlink, (target, ix.ix_path))
+            timer.start()
+            self.assertEqual(other.init().doc_count(), 5)
+            timer.join()
+            self.assertTrue(os.path.islink(ix.ix_path))
+
+            self.search.create_index(self.Post, rebuild=True)
+            self.search.create_index(self.Post, rebuild=True)
+            self.assertEqual(ix.versions(), [2, 3])
+            self.Post(title='new book', content='content').save(self.db)
+            results = self.Post.query.msearch('book').all()
+            self.assertEqual(len(results), 4)
+
+    def test_rebuild_concurrent_writes(self):
+        with self.app.test_request_context():
+            ix = self.search.index(self.Post)
+            document = ix.document
+            written = []
+
+            def write(instance):
+                # rows are changed by another process after being read
+                if not written:
+                    written.append(instance.id)
+                    session = self.db.session.session_factory()
+                    session.get(self.Post, 1).title = 'rebuilt book'
+                    session.delete(session.get(self.Post, 2))
+                    session.add(self.Post(title='inserted book', content=''))
+                    session.commit()
+                    session.close()
+                return document(instance)
+
+            ix._document = write
+            self.search.create_index(self.Post, rebuild=True)
+            ix._document = document
+            self.assertEqual(written, [1])
+            self.assertFalse(os.path.exists(ix.journal_path))
+
+            hits = self.search.msearch_hits(self.Post, 'book')
+            self.assertEqual(
+                set(hit.pk for hit in hits), {'1', '3', '5', '6'})
+            self.assertEqual(ix.searcher.doc_count(), 5)
+
+    def test_reconcile(self):
+        with self.app.test_request_context():
+            ix = self.search.index(self.Post)
+            ix.delete(fieldname='id', text='2')
+            ix.create(id='100', title='orphan book', content='content')
+            ix.commit()
+            results = self.search.msearch_hits(self.Post, 'book')
+            self.assertEqual(set(hit.pk for hit in results), {'3', '5', '100'})
+
+            result = self.search.reconcile(self.Post, batch_size=1)
+            self.assertEqual(result, {"missing": 1, "orphan": 1})
+            self.assertEqual(self.search.metrics["reconcile_missing"], 1)
+            results = self.search.msearch_hits(self.Post, 'book')
+            self.assertEqual(set(hit.pk for hit in results), {'2', '3', '5'})
+
+            result = self.search.reconcile(self.Post)
+            self.assertEqual(result, {"missing": 0, "orphan": 0})
+
+    def test_search_cache(self):
+        with self.app.test_request_context():
+            cache = self.search._backend.cache = SearchCache()
+            results = self.Post.query.msearch('book').all()
+            self.assertEqual(len(results), 3)
+            results = self.Post.query.msearch('book').all()
+            self.assertEqual(len(results), 3)
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+            self.Post(title="new book", content="content").save(self.db)
+            results = self.Post.query.msearch('book').all()
+            self.assertEqual(len(results), 4)
+            self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+            cache.maxsize = 4
+            self.Post.query.msearch('movie').all()
+            self.assertEqual(len(cache), 1)
+            self.assertEqual(cache.size, 1)
+
+    def test_search_hits(self):
+        with self.app.test_request_context():
+            hits = self.search.msearch_hits(self.Post, 'book', limit=2)
+            self.assertEqual(len(hits), 2)
+            self.assertEqual(hits[0].rank, 0)
+            self.assertIn("book", hits[0]["title"])
+            self.assertEqual(hits[0].pk, hits[0]["id"])
+            self.assertTrue(hits[0].score > 0)
+
+    def test_search_page(self):
+        with self.app.test_request_context():
+            pagination = self.Post.query.msearch(
+                'book', page=1, per_page=2, rank_order=True)
+            self.assertEqual(pagination.total, 3)
+            self.assertEqual(pagination.pages, 2)
+            self.assertEqual(len(pagination.items), 2)
+            self.assertTrue(pagination.has_next)
+
+            pagination = self.Post.query.msearch('book', page=2, per_page=2)
+            self.assertEqual(len(pagination.items), 1)
+            self.assertFalse(pagination.has_next)
+
+            pagination = self.Post.query.msearch('abc', page=1)
+            self.assertEqual(pagination.total, 0)
+            self.assertEqual(pagination.items, [])
+
+            pagination = self.Post.query.msearch('book', page=9, per_page=2)
+            self.assertEqual(pagination.total, 3)
+            self.assertEqual(pagination.items, [])
+            with self.assertRaises(ValueError):
+                self.Post.query.msearch('book', page=0)
+
+    def test_rank_order_values(self):
+        with self.app.test_request_context():
+            self.app.config["MSEARCH_RANK_CASE_LIMIT"] = 1
+            query = self.Post.query.msearch('book', rank_order=True)
+            self.assertNotIn("CASE", str(query))
+            results = query.all()
+            hits = self.search.msearch_hits(self.Post, 'book')
+            self.assertEqual([str(i.id) for i in results],
+                             [hit.pk for hit in hits])
+
+            # mysql has no VALUES list, rows are reordered in python
+            hits = [Hit(hit.pk, i) for i, hit in enumerate(reversed(hits))]
+            query = hits_query(self.Post.query, self.Post.id, hits, True, 1,
+                               dialect="mysql")
+            sql = str(query.statement.compile(dialect=mysql.dialect()))
+            self.assertNotIn("VALUES", sql)
+            self.assertNotIn("CASE", sql)
+            self.assertEqual([str(i.id) for i in query.all()],
+                             [hit.pk for hit in hits])
+            self.assertEqual([str(i.id) for i in query],
+                             [hit.pk for hit in hits])
+            self.assertEqual([str(i.id) for i in query.filter(True).all()],
+                             [hit.pk for hit in hits])
+
+
+class TestQueueSignal(SearchTestBase):
+    def setUp(self):
+        super(TestQueueSignal, self).setUp()
+        self.app.config["MSEARCH_QUEUE_INTERVAL"] = 0.2
+        self.search._backend._signal = queue_signal
+        self.init_data()
+
+    def tearDown(self):
+        self.search._queue.stop()
+        super(TestQueueSignal, self).tearDown()
+
+    def init_data(self):
+        super(TestQueueSignal, self).init_data()
+        self.search._queue.join()
+
+    def test_coalesce(self):
+        with self.app.test_request_context():
+            post = self.Post(title='queue', content='content')
+            post.save(self.db)
+            for i in range(5):
+                post.title = 'queue %d' % i
+                post.save(self.db)
+            post.delete(self.db)
+            self.search._queue.join()
+
+            results = self.Post.query.msearch('queue').all()
+            self.assertEqual(len(results), 0)
+            results = self.Post.query.msearch('book').all()
+            self.assertEqual(len(results), 3)
+
+    def test_coalesce_operations(self):
+        with self.app.test_request_context():
+            ix = self.search.index(self.Post)
+            post = self.Post.query.filter_by(title=titles[0]).one()
+            deleted = self.Post.query.filter_by(title=titles[1]).one()
+            applied = []
+            index_queue = IndexQueue(self.search._backend, interval=60)
+            with mock.patch("flask_msearch.signal._apply_operations",
+                            lambda backend, indexs: applied.append(indexs)):
+                index_queue.put(ix, post.id, None, 'insert')
+                index_queue.put(ix, post.id, None, 'update')
+                index_queue.put(ix, deleted.id, None, 'update')
+                index_queue.put(ix, deleted.id, deleted, 'delete')
+                index_queue.stop()
+            self.assertEqual(len(applied), 1)
+            operations = applied[0][ix.name][1]
+            self.assertEqual(
+                [(pk, operation) for pk, (_, operation) in operations.items()],
+                [(str(post.id), 'insert'), (str(deleted.id), 'delete')])
+            self.assertEqual(operations[str(post.id)][0].id, post.id)
+
+
+class TestParallelIndex(SearchTestBase):
+    def setUp(self):
+        class TestConfig(object):
+            SQLALCHEMY_TRACK_MODIFICATIONS = True
+            # forked workers can't share sqlite memory database
+            SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(
+                mkdtemp(), 'test.db')
+            DEBUG = True
+            TESTING = True
+            MSEARCH_INDEX_NAME = mkdtemp()
+            MSEARCH_BACKEND = 'whoosh'
+            MSEARCH_ENABLE = False
+
+        self.app = Flask(__name__)
+        self.app.config.from_object(TestConfig())
+        self.db = SQLAlchemy(self.app)
+        self.search = Search(self.app, db=self.db)
+
+        db = self.db
+
+        class Post(db.Model, ModelSaveMixin):
+            __tablename__ = 'parallel_posts'
+            __searchable__ = ['title', 'content']
+
+            id = db.Column(db.Integer, primary_key=True)
+            title = db.Column(db.String(49))
+            content = db.Column(db.Text)
+
+        self.Post = Post
+        with self.app.test_request_context():
+            db.create_all()
+            for i in range(1500):
+                db.session.add(Post(title=titles[i % 5], content='content'))
+            db.session.commit()
+
+    def test_parallel_index(self):
+        with self.app.test_request_context():
+            results = self.Post.query.msearch('book').all()
+            self.assertEqual(len(results), 0)
+
+            self.search.create_index(self.Post, yield_per=50, procs=2)
+            results = self.Post.query.msearch('book').all()
+            self.assertEqual(len(results), 900)
+
+
+class TestIncrementalIndex(SearchTestBase):
+    def setUp(self):
+        class TestConfig(object):
+            SQLALCHEMY_TRACK_MODIFICATIONS = True
+            SQLALCHEMY_DATABASE_URI = 'sqlite://'
+            DEBUG = True
+            TESTING = True
+            MSEARCH_INDEX_NAME = mkdtemp()
+            MSEARCH_BACKEND = 'whoosh'
+            MSEARCH_ENABLE = False
+
+        self.app = Flask(__name__)
+        self.app.config.from_object(TestConfig())
+        self.db = SQLAlchemy(self.app)
+        self.search = Search(self.app, db=self.db)
+
+        db = self.db
+
+        class Post(db.Model, ModelSaveMixin):
+            __tablename__ = 'incremental_posts'
+            __searchable__ = ['title', 'content']
+            __msearch_updated_at__ = 'updated_at'
+
+            id = db.Column(db.Integer, primary_key=True)
+            title = db.Column(db.String(49))
+            content = db.Column(db.Text)
+            updated_at = db.Column(db.DateTime)
+
+        self.Post = Post
+        with self.app.test_request_context():
+            db.create_all()
+            for i, title in enumerate(titles):
+                db.session.add(
+                    Post(
+                        title=title,
+                        content='content',
+                        updated_at=datetime.datetime(2020, 1, i + 1),
+                    ))
+            db.session.commit()
+
+    def test_incremental_index(self):
+        with self.app.test_request_context():
+            ix = self.search.update_index(self.Post, incremental=True)
+            self.assertEqual(ix.get_meta("watermark"), "2020-01-05T00:00:00")
+            results = self.Post.query.msearch('book').all()
+            self.assertEqual(len(results), 3)
+
+            # only rows since watermark are reindexed
+            post = self.Post.query.filter_by(title=titles[0]).one()
+            post.title = 'watch a book'
+            post.updated_at = datetime.datetime(2020, 1, 6)
+            other = self.Post.query.filter_by(title=titles[1]).one()
+            other.title = 'read a novel'
+            self.db.session.commit()
+
+            self.search.update_index(self.Post, incremental=True)
+            self.assertEqual(ix.get_meta("watermark"), "2020-01-06T00:00:00")
+            results = self.Post.query.msearch('book').all()
+            self.assertEqual(len(results), 4)
+
+            # inserted row without timestamp
+            self.db.session.add(self.Post(title='new book', content=''))
+            self.db.session.commit()
+            self.search.update_index(self.Post, incremental=True)
+            self.assertEqual(ix.get_meta("watermark"), "2020-01-06T00:00:00")
+            results = self.Post.query.msearch('book').all()
+            self.assertEqual(len(results), 5)
+
 
 class TestCaseSearch(SearchTestBase):
     def setUp(self):
@@ -211,6 +733,55 @@ class TestRelationSearch(TestMixin, SearchTestBase):
             results = self.Post.query.msearch('tag', fields=['tag.name']).all()
             self.assertEqual(len(results), 2)
 
+    def test_missing_relation(self):
+        with self.app.test_request_context():
+            post = self.Post.query.first()
+            self.assertIsNone(post.tag)
+            build = document_builder(self.Post, ['tag.name'], {'tag.name': int})
+            self.assertEqual(build(post), {'tag.name': None})
+
+    def test_related_propagation(self):
+        with self.app.test_request_context():
+            post = self.Post(title='related post', content='content')
+            post.tag = self.Tag(name='python')
+            post.save(self.db)
+
+            tag = post.tag
+            tag.name = 'golang'
+            tag.save(self.db)
+            self.assertEqual(self.search.metrics["related_indexed"], 1)
+
+            results = self.Post.query.msearch(
+                'golang', fields=['tag.name']).all()
+            self.assertEqual(len(results), 1)
+            # whole document is reindexed instead of partial attrs
+            results = self.Post.query.msearch('related', fields=['title']).all()
+            self.assertEqual(len(results), 1)
+
+    def test_eager_index(self):
+        with self.app.test_request_context():
+            for i in range(20):
+                post = self.Post(title='eager %d' % i, content='content')
+                post.tag = self.Tag(name='eager tag %d' % i)
+                self.db.session.add(post)
+            self.db.session.commit()
+
+            statements = []
+
+            def before_cursor_execute(conn, cursor, statement, *args):
+                statements.append(statement)
+
+            event.listen(self.db.engine, 'before_cursor_execute',
+                         before_cursor_execute)
+            self.search.create_index(self.Post, update=True, yield_per=10)
+            event.remove(self.db.engine, 'before_cursor_execute',
+                         before_cursor_execute)
+            self.assertEqual(len(statements), 1)
+
+            results = self.Post.query.msearch(
+                'eager', fields=['tag.name']).all()
+            self.assertEqual(len(results), 20)
+
 
 class TestSearchHybridProp(TestMixin, SearchTestBase):
     def setUp(self):
@@ -307,6 +878,17 @@ class TestHybridPropTypeHint(SearchTestBase):
                 '2017-05-04', fields=['fts_date']).all()
             self.assertEqual(len(results), 10)
 
+    def test_native_document(self):
+        with self.app.test_request_context():
+            ix = self.search.index(self.Post)
+            post = self.Post.query.filter_by(name='post 9').one()
+            self.assertEqual(
+                ix.document(post), {
+                    "id": "10",
+                    "fts_int": 27,
+                    "fts_date": datetime.datetime(2017, 5, 4),
+                })
+
 
 class TestPrimaryKey(TestMixin, SearchTestBase):
     def setUp(self):
@@ -350,6 +932,9 @@ if __name__ == '__main__':
     suite = unittest.TestLoader().loadTestsFromNames(
         [
             'test_whoosh.TestSearch',
+            'test_whoosh.TestQueueSignal',
+            'test_whoosh.TestParallelIndex',
+            'test_whoosh.TestIncrementalIndex',
             # 'test_whoosh.TestPrimaryKey',
             'test_whoosh.TestCaseSearch',
             'test_whoosh.TestRelationSearch',